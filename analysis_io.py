@@ -0,0 +1,135 @@
+# Compact storage of ncbi_consensus analyses (--dump / --explore). Instead
+# of pickling the whole annotated tree, the topology is saved as a plain
+# newick string and node data as columns (numpy arrays, one entry per node
+# in preorder) in a compressed .npz file:
+#
+#   name, dist, support, taxid, spname, changed (-1 unset, 0 no, 1 yes)
+#   lineage, lineage_offsets      lineage taxids of node i are
+#                                 lineage[lineage_offsets[i]:lineage_offsets[i+1]]
+#   broken, broken_offsets        broken groups given as taxids (leaves),
+#   broken_names, ...             and as names (internal nodes), same layout
+#   tax_ids, tax_names            names of all the taxids above
+#
+# Files do not depend on ete internals, and loading only parses the
+# topology. Node data is set when nodes are first accessed through
+# Analysis.annotate() (i.e. from a layout function).
+import numpy
+
+from ete_dev import PhyloTree
+from newick_io import write_newicks
+
+FORMAT_VERSION = 1
+CHANGED_CODES = {None: -1, "no": 0, "yes": 1}
+CHANGED_VALUES = {-1: None, 0: "no", 1: "yes"}
+
+class _TopologyWriter(object):
+    # file-like object collecting write_newicks() output
+    def __init__(self):
+        self.chunks = []
+
+    def write(self, text):
+        self.chunks.append(text)
+
+def _flatten(lists, dtype=numpy.int64):
+    offsets = [0]
+    values = []
+    for items in lists:
+        values.extend(items)
+        offsets.append(len(values))
+    return numpy.array(values, dtype=dtype), numpy.array(offsets, dtype=numpy.int64)
+
+def save_analysis(t, fname):
+    nodes = list(t.traverse("preorder"))
+    topology = _TopologyWriter()
+    write_newicks(t, lambda node: node.children, [(topology, lambda node, is_leaf: "")])
+
+    tax2name = {}
+    lineages = []
+    broken_ids = []
+    broken_names = []
+    for node in nodes:
+        lineage = getattr(node, "lineage", None) or []
+        lineages.append(lineage)
+        tax2name.update(zip(lineage, getattr(node, "named_lineage", [])))
+        groups = getattr(node, "broken_groups", None) or []
+        # analyze_subtrees() stores taxids in leaves and names in internal
+        # nodes
+        broken_ids.append(sorted([g for g in groups if not isinstance(g, basestring)]))
+        broken_names.append(sorted([g for g in groups if isinstance(g, basestring)]))
+    lineage, lineage_offsets = _flatten(lineages)
+    broken, broken_offsets = _flatten(broken_ids)
+    broken_names, broken_names_offsets = _flatten(broken_names, None)
+    tax_ids = sorted(tax2name)
+
+    numpy.savez_compressed(
+        fname,
+        format_version=numpy.array(FORMAT_VERSION),
+        topology=numpy.array(''.join(topology.chunks)),
+        name=numpy.array([node.name for node in nodes]),
+        dist=numpy.array([node.dist for node in nodes], dtype=numpy.float64),
+        support=numpy.array([node.support for node in nodes], dtype=numpy.float64),
+        taxid=numpy.array([str(getattr(node, "taxid", "")) for node in nodes]),
+        spname=numpy.array([getattr(node, "spname", "") for node in nodes]),
+        changed=numpy.array([CHANGED_CODES[getattr(node, "changed", None)] for node in nodes],
+                            dtype=numpy.int8),
+        lineage=lineage,
+        lineage_offsets=lineage_offsets,
+        broken=broken,
+        broken_offsets=broken_offsets,
+        broken_names=broken_names,
+        broken_names_offsets=broken_names_offsets,
+        tax_ids=numpy.array(tax_ids, dtype=numpy.int64),
+        tax_names=numpy.array([tax2name[tax] for tax in tax_ids]))
+
+class Analysis(object):
+    # Analysis loaded from a file written by save_analysis(). Columns are
+    # read from the file on first use.
+    def __init__(self, fname):
+        self.data = numpy.load(fname)
+        if int(self.data["format_version"]) != FORMAT_VERSION:
+            raise ValueError("Unsupported analysis format in %s" %fname)
+        self._columns = {}
+        self._tax2name = None
+        self.tree = PhyloTree(str(self.data["topology"]), format=100,
+                              sp_naming_function=None)
+        # nodes not annotated yet -> preorder index
+        self._pending = dict([(node, i) for i, node in
+                              enumerate(self.tree.traverse("preorder"))])
+
+    def column(self, name):
+        if name not in self._columns:
+            self._columns[name] = self.data[name]
+        return self._columns[name]
+
+    def _items(self, name, index, convert=int):
+        offsets = self.column(name + "_offsets")
+        return [convert(v) for v in self.column(name)[offsets[index]:offsets[index+1]]]
+
+    def annotate(self, node):
+        # Sets the saved data of node, only the first time it is called
+        index = self._pending.pop(node, None)
+        if index is None:
+            return
+        if self._tax2name is None:
+            self._tax2name = dict(zip([int(tax) for tax in self.column("tax_ids")],
+                                      [unicode(name) for name in self.column("tax_names")]))
+        node.name = str(self.column("name")[index])
+        node.dist = float(self.column("dist")[index])
+        node.support = float(self.column("support")[index])
+        changed = CHANGED_VALUES[int(self.column("changed")[index])]
+        if changed is not None:
+            node.add_feature("changed", changed)
+        if not node.children:
+            taxid = str(self.column("taxid")[index])
+            node.add_features(taxid=taxid, species=taxid,
+                              spname=unicode(self.column("spname")[index]))
+            node.lineage = self._items("lineage", index)
+            node.named_lineage = [self._tax2name[tax] for tax in node.lineage]
+        broken = self._items("broken", index) + self._items("broken_names", index, unicode)
+        if broken:
+            node.broken_groups = set(broken)
+
+    def annotate_all(self):
+        for node in self.tree.traverse("preorder"):
+            self.annotate(node)
+        return self.tree
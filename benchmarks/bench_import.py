@@ -0,0 +1,80 @@
+#!/usr/bin/env python
+# Import-time regression guard for ncbi_query.
+#
+# Importing ncbi_query must not import ete2, configure logging or open the
+# DB, and the CLI name translation path must never import ete2. The best
+# time of "import ncbi_query" over a bare interpreter start must stay within
+# the given budget. Exits with status 1 if any of these checks fail.
+import sys
+import os
+import subprocess
+import time
+from argparse import ArgumentParser
+
+REPO_PATH = os.path.split(os.path.split(os.path.realpath(__file__))[0])[0]
+
+IMPORT_CHECK = """
+import sys, logging
+sys.path.insert(0, %r)
+import ncbi_query
+assert 'ete2' not in sys.modules, 'ete2 imported'
+assert ncbi_query.c._conn is None, 'DB opened at import time'
+assert not logging.getLogger().handlers, 'logging configured at import time'
+""" %REPO_PATH
+
+CLI_CHECK = """
+import sys, runpy
+sys.path.insert(0, %r)
+sys.argv = ['ncbi_query.py', '-n', 'Homo sapiens']
+try:
+    runpy.run_path(%r, run_name='__main__')
+finally:
+    assert 'ete2' not in sys.modules, 'ete2 imported by name translation'
+""" %(REPO_PATH, os.path.join(REPO_PATH, "ncbi_query.py"))
+
+def min_runtimes(codes, runs):
+    # Best time of each piece of code over `runs` interpreter starts. Runs
+    # are interleaved, so load changes affect all of them alike, and the
+    # minimum is the least noisy estimate of the actual cost.
+    times = [[] for code in codes]
+    for i in xrange(runs):
+        for code, code_times in zip(codes, times):
+            t1 = time.time()
+            subprocess.check_call([sys.executable, "-c", code])
+            code_times.append(time.time() - t1)
+    return [min(code_times) for code_times in times]
+
+def check(code, descr):
+    proc = subprocess.Popen([sys.executable, "-c", code],
+                            stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+    out, err = proc.communicate()
+    if proc.returncode:
+        print "FAILED:", descr
+        print err.strip().split("\n")[-1]
+        return False
+    print "OK:", descr
+    return True
+
+if __name__ == "__main__":
+    parser = ArgumentParser(description="ncbi_query import time benchmark")
+    parser.add_argument("--runs", dest="runs", type=int, default=30,
+                        help="Number of interpreter starts to time")
+    parser.add_argument("--budget_ms", dest="budget_ms", type=float, default=50,
+                        help="Maximum allowed import overhead, in milliseconds")
+    args = parser.parse_args()
+
+    ok = check(IMPORT_CHECK, "import ncbi_query is side effect free")
+    if os.path.exists(os.path.join(REPO_PATH, "taxa.sqlite")):
+        ok &= check(CLI_CHECK, "CLI name translation does not import ete2")
+    else:
+        print "SKIPPED: CLI name translation check (taxa.sqlite not found)"
+
+    base, imported = min_runtimes(
+        ["pass", "import sys; sys.path.insert(0, %r); import ncbi_query" %REPO_PATH],
+        args.runs)
+    overhead = (imported - base) * 1000
+    print "import ncbi_query: %0.1f ms over interpreter startup (budget %0.1f ms)" %(overhead, args.budget_ms)
+    if overhead > args.budget_ms:
+        print "FAILED: import time budget exceeded"
+        ok = False
+    sys.exit(0 if ok else 1)
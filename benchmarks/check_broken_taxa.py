@@ -0,0 +1,116 @@
+#!/usr/bin/env python
+# Equivalence guard for ncbi_consensus.analyze_tracks().
+#
+# Random gene trees (multifurcations, caterpillars, single child nodes)
+# are annotated with lineages drawn from a random taxonomy, including
+# leaves without lineage and repeated species. The broken and
+# monophyletic taxa found by analyze_tracks() must be the same as those of
+# the original implementation, kept below as reference_analyze_tracks().
+# Exits with status 1 on the first mismatch, printing the tree.
+#
+#   $ python benchmarks/check_broken_taxa.py --trees 500 --seed 1
+import sys
+import os
+import random
+from collections import defaultdict
+from argparse import ArgumentParser
+
+REPO_PATH = os.path.split(os.path.split(os.path.realpath(__file__))[0])[0]
+sys.path.insert(0, REPO_PATH)
+
+from ete_dev import Tree
+import ncbi_consensus
+
+def reference_analyze_tracks(t, n2content):
+    # analyze_tracks() before the single pass version
+    counterdict = lambda: defaultdict(int)
+    node2track = defaultdict(counterdict)
+    taxcounter = defaultdict(int)
+    tax2name = {}
+    for node, leaves in n2content.iteritems():
+        if node.is_leaf():
+            for index, tax in enumerate(node.lineage):
+                taxcounter[tax] += 1
+                tax2name[tax] = node.named_lineage[index]
+        else:
+            for lf in leaves:
+                for index, tax in enumerate(lf.lineage):
+                    node2track[node][tax] += 1
+
+    mono = set(taxcounter.keys())
+    non_mono = set()
+    for node, taxa in node2track.iteritems():
+        for tax, num in taxa.iteritems():
+            if taxcounter[tax] != num and len(n2content[node]) != num:
+                mono.discard(tax)
+                non_mono.add(tax)
+    return mono, non_mono, tax2name
+
+def random_lineages(rnd, size):
+    # Root to tip lineages of the nodes of a random taxonomy of the given
+    # size. Taxid 1 is the root.
+    lineages = {1: [1]}
+    for taxid in xrange(2, size + 2):
+        parent = rnd.choice(lineages.keys())
+        lineages[taxid] = lineages[parent] + [taxid]
+    return lineages.values()
+
+def random_tree(rnd, size, polytomies=0.2, single_children=0.05, caterpillar=False):
+    nodes = [Tree() for i in xrange(size)]
+    while len(nodes) > 1:
+        nchildren = 2
+        if rnd.random() < polytomies:
+            nchildren = rnd.randint(2, min(4, len(nodes)))
+        parent = Tree()
+        for i in xrange(nchildren):
+            if caterpillar and i == 0:
+                parent.add_child(nodes.pop())
+            else:
+                parent.add_child(nodes.pop(rnd.randrange(len(nodes))))
+        if rnd.random() < single_children:
+            grandparent = Tree()
+            grandparent.add_child(parent)
+            parent = grandparent
+        nodes.append(parent)
+    return nodes[0]
+
+def random_case(rnd, max_leaves):
+    lineages = random_lineages(rnd, rnd.randint(1, 60))
+    # a few species, so that most of them are repeated
+    species = rnd.sample(lineages, min(len(lineages), rnd.randint(1, max_leaves)))
+    t = random_tree(rnd, rnd.randint(1, max_leaves), caterpillar=rnd.random() < 0.2)
+    for i, leaf in enumerate(t.iter_leaves()):
+        leaf.name = "leaf%d" %i
+        if rnd.random() < 0.05:
+            leaf.lineage = []
+        else:
+            leaf.lineage = list(rnd.choice(species))
+        leaf.named_lineage = ["tax%d" %tax for tax in leaf.lineage]
+    return t
+
+if __name__ == "__main__":
+    parser = ArgumentParser(description="Broken NCBI taxa check against the original algorithm")
+    parser.add_argument("--trees", dest="trees", type=int, default=500,
+                        help="Number of random gene trees to check")
+    parser.add_argument("--max_leaves", dest="max_leaves", type=int, default=60,
+                        help="Maximum number of leaves per tree")
+    parser.add_argument("--seed", dest="seed", type=int, default=1,
+                        help="Random seed")
+    args = parser.parse_args()
+
+    rnd = random.Random(args.seed)
+    broken = 0
+    for i in xrange(args.trees):
+        t = random_case(rnd, args.max_leaves)
+        n2content = t.get_cached_content()
+        expected = reference_analyze_tracks(t, n2content)
+        found = ncbi_consensus.analyze_tracks(t, n2content)
+        if expected != found:
+            print "FAILED: case %d" %i
+            print "  tree:", t.write(format=9, features=["lineage"])
+            print "  expected mono/broken:", sorted(expected[0]), sorted(expected[1])
+            print "  found mono/broken:   ", sorted(found[0]), sorted(found[1])
+            sys.exit(1)
+        if expected[1]:
+            broken += 1
+    print "OK: %d gene trees (%d with broken taxa) give the same taxa" %(args.trees, broken)
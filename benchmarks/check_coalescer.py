@@ -0,0 +1,90 @@
+#!/usr/bin/env python
+# Regression guard for the request coalescing of ncbi_server.
+#
+# Concurrent get_taxid_translator, get_sp_lineage and get_name_translator
+# requests are sent through the coalescers of ncbi_server with a window
+# long enough to merge them into a single batch, against a small DB created
+# in a temporary directory. Some requests carry invalid taxids or names:
+# they must be skipped or fail on their own, while the other requests of
+# the same batch get their normal results. Exits with status 1 if any check
+# fails.
+#
+#   $ python benchmarks/check_coalescer.py
+import sys
+import os
+import shutil
+import sqlite3
+import tempfile
+import threading
+
+REPO_PATH = os.path.split(os.path.split(os.path.realpath(__file__))[0])[0]
+sys.path.insert(0, REPO_PATH)
+
+import ncbi_query as ncbi
+import ncbi_server
+
+SPECIES = [(1, "root", "1"),
+           (2, "Bacteria", "2,1"),
+           (10, "Escherichia coli", "10,2,1")]
+
+# (method, argument, expected result or exception class)
+REQUESTS = [("get_taxid_translator", [10, "2"], {10: "Escherichia coli", 2: "Bacteria"}),
+            ("get_taxid_translator", ["abc", 10, None, [], '1") OR ("1'],
+             {10: "Escherichia coli"}),
+            ("get_taxid_translator", 10, TypeError),
+            ("get_taxid_translator", [1], {1: "root"}),
+            ("get_sp_lineage", 10, [1, 2, 10]),
+            ("get_sp_lineage", "10", [1, 2, 10]),
+            ("get_sp_lineage", "abc", ValueError),
+            ("get_sp_lineage", None, None),
+            ("get_sp_lineage", 99, [1]),
+            ("get_name_translator", ["Bacteria", "escherichia coli"],
+             {"Bacteria": 2, "escherichia coli": 10}),
+            ("get_name_translator", ["Bacteria", 10], ValueError)]
+
+def create_db(fname):
+    db = sqlite3.connect(fname)
+    db.execute("CREATE TABLE species (taxid INT PRIMARY KEY, spname VARCHAR(50) COLLATE NOCASE,"
+               " track TEXT);")
+    db.execute("CREATE TABLE synonym (taxid INT, spname VARCHAR(50) COLLATE NOCASE);")
+    db.executemany("INSERT INTO species VALUES (?, ?, ?);", SPECIES)
+    db.commit()
+    db.close()
+
+def send(method, arg, results, index):
+    try:
+        results[index] = ncbi_server.dispatch(method, [arg], {})
+    except Exception, e:
+        results[index] = e
+
+if __name__ == "__main__":
+    workdir = tempfile.mkdtemp(prefix="ncbi_server_")
+    try:
+        dbfile = os.path.join(workdir, "taxa.sqlite")
+        create_db(dbfile)
+        ncbi.c = sqlite3.connect(dbfile, check_same_thread=False)
+        ncbi_server.enable_coalescing(0.5, 500)
+        results = [None] * len(REQUESTS)
+        threads = [threading.Thread(target=send, args=(method, arg, results, i))
+                   for i, (method, arg, expected) in enumerate(REQUESTS)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+    finally:
+        shutil.rmtree(workdir)
+
+    ok = True
+    for (method, arg, expected), found in zip(REQUESTS, results):
+        if isinstance(expected, type):
+            passed = isinstance(found, expected)
+        else:
+            passed = found == expected
+        if not passed:
+            print "FAILED: %s(%r) -> %r (%r expected)" %(method, arg, found, expected)
+            ok = False
+    batches = sum([stats["batches"] for stats in ncbi_server.get_stats().itervalues()])
+    if ok:
+        print "OK: %d requests in %d coalesced batches, invalid ids handled per request" %(
+            len(REQUESTS), batches)
+    sys.exit(0 if ok else 1)
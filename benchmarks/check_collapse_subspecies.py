@@ -0,0 +1,88 @@
+#!/usr/bin/env python
+# Equivalence guard for ncbi_query.collapse_subspecies().
+#
+# Random taxonomies with several levels of subspecies, varieties and
+# strains below the species are collapsed by collapse_subspecies() and by
+# the original --collapse_subspecies code, kept below as
+# reference_collapse_subspecies(). Extended newick output (node order,
+# names and features) must be identical. Exits with status 1 on the first
+# mismatch.
+#
+#   $ python benchmarks/check_collapse_subspecies.py --trees 300 --seed 1
+import sys
+import os
+import random
+from argparse import ArgumentParser
+
+REPO_PATH = os.path.split(os.path.split(os.path.realpath(__file__))[0])[0]
+sys.path.insert(0, REPO_PATH)
+
+from ete2 import PhyloTree
+import ncbi_query as ncbi
+
+RANKS = ["genus", "species", "subspecies", "varietas", "no rank"]
+
+def reference_collapse_subspecies(t, all_taxids):
+    # --collapse_subspecies code of ncbi_query.py before collapse_subspecies()
+    species_nodes = [n for n in t.traverse() if n.rank == "species"
+                     if int(n.taxid) in all_taxids]
+    for sp_node in species_nodes:
+        bellow = sp_node.get_descendants()
+        if bellow:
+            connector = sp_node.__class__()
+            for f in sp_node.features:
+                connector.add_feature(f, getattr(sp_node, f))
+            connector.name = connector.name + "{species}"
+            for n in bellow:
+                n.detach()
+                n.name = n.name + "{%s}" %n.rank
+                sp_node.add_child(n)
+            sp_node.add_child(connector)
+            sp_node.add_feature("collapse_subspecies", "1")
+
+def random_taxonomy(rnd, size):
+    # Nodes are named and annotated as in the --taxonomy CLI code
+    root = PhyloTree()
+    root.add_features(taxid="1", rank="genus")
+    nodes = [(root, 0)]
+    for taxid in xrange(2, size + 2):
+        parent, level = rnd.choice(nodes)
+        node = parent.add_child()
+        level = min(level + 1, len(RANKS) - 1)
+        node.add_features(taxid=str(taxid), rank=RANKS[level])
+        nodes.append((node, level))
+    for n in root.traverse():
+        n.add_features(sci_name="tax%s" %n.taxid)
+        n.name = "tax%s{%s}" %(n.taxid, n.taxid)
+    return root
+
+if __name__ == "__main__":
+    parser = ArgumentParser(description="collapse_subspecies() check against the original code")
+    parser.add_argument("--trees", dest="trees", type=int, default=300,
+                        help="Number of random taxonomies to check")
+    parser.add_argument("--max_nodes", dest="max_nodes", type=int, default=80,
+                        help="Maximum number of nodes per taxonomy")
+    parser.add_argument("--seed", dest="seed", type=int, default=1,
+                        help="Random seed")
+    args = parser.parse_args()
+
+    rnd = random.Random(args.seed)
+    collapsed = 0
+    for i in xrange(args.trees):
+        seed = rnd.random()
+        size = rnd.randint(1, args.max_nodes)
+        expected = random_taxonomy(random.Random(seed), size)
+        found = random_taxonomy(random.Random(seed), size)
+        taxids = set([int(n.taxid) for n in expected.traverse() if rnd.random() < 0.7])
+        reference_collapse_subspecies(expected, taxids)
+        ncbi.collapse_subspecies(found, taxids)
+        expected = expected.write(format=1, features=ncbi.NEWICK_FEATURES)
+        found = found.write(format=1, features=ncbi.NEWICK_FEATURES)
+        if expected != found:
+            print "FAILED: case %d" %i
+            print "  expected:", expected
+            print "  found:   ", found
+            sys.exit(1)
+        if "collapse_subspecies" in found:
+            collapsed += 1
+    print "OK: %d taxonomies (%d with collapsed species) give the same newick" %(args.trees, collapsed)
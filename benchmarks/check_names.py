@@ -0,0 +1,78 @@
+#!/usr/bin/env python
+# Regression guard for the normalized name lookups of ncbi_query.
+#
+# A small DB with a species, its strains, a synonym and two taxa sharing a
+# normalized name is created in a temporary directory, with the same keys
+# update_taxadb.py stores. Formatting variants of those names must resolve
+# to the expected taxids, and ambiguous ones must stay unresolved. Exits
+# with status 1 if any check fails.
+#
+#   $ python benchmarks/check_names.py
+import sys
+import os
+import shutil
+import sqlite3
+import tempfile
+
+REPO_PATH = os.path.split(os.path.split(os.path.realpath(__file__))[0])[0]
+sys.path.insert(0, REPO_PATH)
+
+import ncbi_query as ncbi
+from name_keys import normalize_name
+
+SPECIES = [(10, "Escherichia coli"),
+           (11, "Escherichia coli str. K-12"),
+           (12, "Escherichia coli str. K-12 substr. MG1655"),
+           (13, "Escherichia coli O157 H7"),
+           (20, "Salmonella enterica subsp. enterica serovar Typhi"),
+           (21, "Salmonella enterica subsp. enterica serovar Typhimurium"),
+           (30, "Aus bus"),
+           (31, "Aus_bus")]
+SYNONYMS = [(10, "Bacterium coli")]
+
+# query -> expected taxid (None: unresolved)
+EXPECTED = {"Escherichia_coli": 10,
+            "Escherichia  coli sp.": 10,
+            "Escherichia coli (Migula, 1895)": 10,
+            "escherichia_coli str. K-12": 11,
+            "Escherichia coli str. K-12 substr. MG1655": 12,
+            "Escherichia_coli_str._K-12_substr._MG1655": 12,
+            "Escherichia coli str. unknown": 10,
+            "Escherichia coli O157  H7": 13,
+            "Salmonella_enterica subsp. enterica serovar Typhi": 20,
+            "Salmonella enterica subsp. enterica serovar_Typhimurium": 21,
+            "Bacterium_coli": 10,
+            "Aus  bus": None}
+
+def create_db(fname):
+    db = sqlite3.connect(fname)
+    db.execute("CREATE TABLE species (taxid INT PRIMARY KEY, spname VARCHAR(50) COLLATE NOCASE,"
+               " normname VARCHAR(50));")
+    db.execute("CREATE TABLE synonym (taxid INT, spname VARCHAR(50) COLLATE NOCASE,"
+               " normname VARCHAR(50));")
+    for table, rows in [("species", SPECIES), ("synonym", SYNONYMS)]:
+        for taxid, name in rows:
+            # same key as update_taxadb.name_key_fields()
+            db.execute("INSERT INTO %s VALUES (?, ?, ?);" %table,
+                       (taxid, name, normalize_name(name, strip_strains=False)))
+    db.commit()
+    db.close()
+
+if __name__ == "__main__":
+    workdir = tempfile.mkdtemp(prefix="ncbi_names_")
+    try:
+        dbfile = os.path.join(workdir, "taxa.sqlite")
+        create_db(dbfile)
+        ncbi.c = ncbi.LazyConnection(dbfile)
+        name2id = ncbi.get_name_translator(set(EXPECTED))
+    finally:
+        shutil.rmtree(workdir)
+
+    ok = True
+    for name in sorted(EXPECTED):
+        if name2id.get(name) != EXPECTED[name]:
+            print "FAILED: %r -> %s (%s expected)" %(name, name2id.get(name), EXPECTED[name])
+            ok = False
+    if ok:
+        print "OK: %d name variants resolved as expected" %len(EXPECTED)
+    sys.exit(0 if ok else 1)
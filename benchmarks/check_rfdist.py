@@ -0,0 +1,98 @@
+#!/usr/bin/env python
+# Equivalence guard for rfdist.RFReference.
+#
+# Random pairs of trees (multifurcations, single child nodes, leaves
+# without the compared attribute, duplicated names, partial overlaps) are
+# compared with ete's robinson_foulds() and with an RFReference built from
+# the same reference tree. RF, max RF and common names must be the same,
+# and both must raise the same errors. Exits with status 1 on the first
+# mismatch, printing both trees.
+#
+#   $ python benchmarks/check_rfdist.py --trees 3000 --seed 1
+import sys
+import os
+import random
+from argparse import ArgumentParser
+
+REPO_PATH = os.path.split(os.path.split(os.path.realpath(__file__))[0])[0]
+sys.path.insert(0, REPO_PATH)
+
+from ete_dev import Tree
+from ete_dev.coretype.tree import TreeError
+from rfdist import RFReference
+
+def random_tree(rnd, names, polytomies=0.2, single_children=0.05):
+    nodes = []
+    for name in names:
+        leaf = Tree()
+        leaf.name = name
+        nodes.append(leaf)
+    while len(nodes) > 1:
+        size = 2
+        if rnd.random() < polytomies:
+            size = rnd.randint(2, min(4, len(nodes)))
+        parent = Tree()
+        for i in xrange(size):
+            parent.add_child(nodes.pop(rnd.randrange(len(nodes))))
+        if rnd.random() < single_children:
+            grandparent = Tree()
+            grandparent.add_child(parent)
+            parent = grandparent
+        nodes.append(parent)
+    return nodes[0]
+
+def random_case(rnd, max_leaves):
+    pool = ["s%d" %i for i in xrange(rnd.randint(1, max_leaves))]
+    ref_names = rnd.sample(pool, rnd.randint(1, len(pool)))
+    if rnd.random() < 0.05:
+        # duplicated name in the reference
+        ref_names.append(pool[0])
+    names = rnd.sample(pool, rnd.randint(1, len(pool)))
+    # duplicated names in the compared tree
+    names = [rnd.choice(pool) if rnd.random() < 0.05 else name for name in names]
+    ref = random_tree(rnd, ref_names)
+    t = random_tree(rnd, names)
+    for leaf in t.iter_leaves():
+        if rnd.random() > 0.1:
+            leaf.add_feature("taxid", leaf.name)
+    return t, ref
+
+def ete_rf(t, ref):
+    try:
+        rf = t.robinson_foulds(ref, attr_t1="taxid")
+    except TreeError, e:
+        return str(e)
+    return rf[0], rf[1], rf[2], len(rf[3]), len(rf[4])
+
+def indexed_rf(t, ref):
+    try:
+        rf = RFReference(ref).robinson_foulds(t, attr_t1="taxid")
+    except TreeError, e:
+        return str(e)
+    return rf[0], rf[1], rf[2], len(rf[3]), len(rf[4])
+
+if __name__ == "__main__":
+    parser = ArgumentParser(description="rfdist vs ete robinson_foulds() check")
+    parser.add_argument("--trees", dest="trees", type=int, default=3000,
+                        help="Number of random tree pairs to compare")
+    parser.add_argument("--max_leaves", dest="max_leaves", type=int, default=40,
+                        help="Maximum number of distinct leaf names per case")
+    parser.add_argument("--seed", dest="seed", type=int, default=1,
+                        help="Random seed")
+    args = parser.parse_args()
+
+    rnd = random.Random(args.seed)
+    errors = 0
+    for i in xrange(args.trees):
+        t, ref = random_case(rnd, args.max_leaves)
+        expected, found = ete_rf(t, ref), indexed_rf(t, ref)
+        if expected != found:
+            print "FAILED: case %d" %i
+            print "  tree:     ", t.write(format=9, features=["taxid"])
+            print "  reference:", ref.write(format=9)
+            print "  ete:      ", expected
+            print "  rfdist:   ", found
+            sys.exit(1)
+        if isinstance(expected, str):
+            errors += 1
+    print "OK: %d tree pairs (%d raising TreeError) give the same RF" %(args.trees, errors)
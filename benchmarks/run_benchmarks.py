@@ -0,0 +1,254 @@
+#!/usr/bin/env python
+# Benchmark suite for ncbi_query, update_taxadb and ncbi_consensus.
+#
+# A synthetic taxdump of the requested size is generated (see taxdump.py)
+# and loaded with update_taxadb.py, then the main operations are timed
+# against the resulting DB. Everything runs offline. For each operation,
+# throughput, latency percentiles and how much it raised the peak RSS of
+# the process are reported, and results are saved as JSON so they can be
+# compared across commits (--compare).
+#
+#   $ python benchmarks/run_benchmarks.py --nodes 100000
+#   $ python benchmarks/run_benchmarks.py --nodes 100000 --compare benchmarks/results/<previous>.json
+import sys
+import os
+import json
+import time
+import random
+import resource
+import shutil
+import subprocess
+import tempfile
+from argparse import ArgumentParser, Namespace
+
+BENCH_PATH = os.path.split(os.path.realpath(__file__))[0]
+REPO_PATH = os.path.split(BENCH_PATH)[0]
+sys.path.insert(0, REPO_PATH)
+
+import ncbi_query as ncbi
+from taxdump import generate_taxdump
+
+def peak_rss_mb(who=resource.RUSAGE_SELF):
+    # ru_maxrss is in KB on Linux. It is the peak of the whole process, so
+    # operations report how much they raised it (rss_growth_mb).
+    return resource.getrusage(who).ru_maxrss / 1024.0
+
+def summarize(latencies, items, rss_growth):
+    latencies = sorted(latencies)
+    total = sum(latencies)
+    def percentile(p):
+        return latencies[min(len(latencies) - 1, int(len(latencies) * p))] * 1000
+    return {"calls": len(latencies),
+            "items": items,
+            "total_s": total,
+            "throughput": items / total if total else 0.0,
+            "p50_ms": percentile(0.50),
+            "p95_ms": percentile(0.95),
+            "p99_ms": percentile(0.99),
+            "rss_growth_mb": rss_growth}
+
+def bench(fn, inputs, items_per_call=1):
+    latencies = []
+    rss = peak_rss_mb()
+    for value in inputs:
+        t1 = time.time()
+        fn(value)
+        latencies.append(time.time() - t1)
+    return summarize(latencies, len(latencies) * items_per_call, peak_rss_mb() - rss)
+
+def bench_update(workdir):
+    t1 = time.time()
+    subprocess.check_call([sys.executable, os.path.join(REPO_PATH, "update_taxadb.py")],
+                          cwd=workdir, stdout=open(os.path.join(workdir, "update.log"), "w"))
+    elapsed = time.time() - t1
+    # the only child process so far, so this is its own peak
+    return summarize([elapsed], 1, peak_rss_mb(resource.RUSAGE_CHILDREN))
+
+def load_fuzzy_connection(dbfile):
+    # Fuzzy search needs sqlite extension loading and the compiled
+    # levenshtein extension. Returns None if not available.
+    extension = os.path.join(REPO_PATH, "SQLite-Levenshtein/levenshtein.sqlext")
+    if not os.path.exists(extension):
+        return None
+    import sqlite3
+    if not hasattr(sqlite3.Connection, "enable_load_extension"):
+        try:
+            import pysqlite2.dbapi2 as sqlite3
+        except ImportError:
+            return None
+    conn = sqlite3.connect(dbfile)
+    conn.enable_load_extension(True)
+    conn.execute("select load_extension('%s')" %extension)
+    return conn
+
+def mutate(rnd, name):
+    chars = list(name)
+    for i in xrange(rnd.randint(1, 2)):
+        pos = rnd.randrange(len(chars))
+        chars[pos] = rnd.choice("abcdefghijklmnopqrstuvwxyz")
+    return "".join(chars)
+
+def random_gene_tree(rnd, species, size):
+    # Random gene tree with leaves named by species taxids. Species are
+    # repeated, so the tree contains duplications.
+    from ete2 import PhyloTree
+    nodes = []
+    for i in xrange(size):
+        leaf = PhyloTree()
+        leaf.name = str(rnd.choice(species))
+        nodes.append(leaf)
+    while len(nodes) > 1:
+        a = nodes.pop(rnd.randrange(len(nodes)))
+        b = nodes.pop(rnd.randrange(len(nodes)))
+        parent = PhyloTree()
+        parent.add_child(a)
+        parent.add_child(b)
+        nodes.append(parent)
+    return nodes[0]
+
+def run(args):
+    rnd = random.Random(args.seed)
+    workdir = args.workdir or tempfile.mkdtemp(prefix="ncbi_bench_")
+    if not os.path.exists(workdir):
+        os.makedirs(workdir)
+    dbfile = os.path.join(workdir, "taxa.sqlite")
+    results = {}
+
+    if not args.skip_update or not os.path.exists(dbfile):
+        print >>sys.stderr, "Generating taxdump with %d nodes in %s" %(args.nodes, workdir)
+        generate_taxdump(workdir, args.nodes, args.seed)
+        print >>sys.stderr, "Running update_taxadb.py"
+        results["update_taxadb"] = bench_update(workdir)
+
+    ncbi.c = ncbi.LazyConnection(dbfile)
+    ncbi.FUZZY_CACHE_FILE = os.path.join(workdir, "fuzzy_cache.sqlite")
+    names = [row[0] for row in ncbi.c.execute("SELECT spname FROM species;")]
+    taxids = [row[0] for row in ncbi.c.execute("SELECT taxid FROM species;")]
+    species = [row[0] for row in ncbi.c.execute("SELECT taxid FROM species WHERE rank='species';")]
+    if not names or not species:
+        raise ValueError("The synthetic taxonomy has no species, try a larger --nodes value")
+    nq = args.queries
+
+    print >>sys.stderr, "Benchmarking get_name_translator"
+    batches = [set(rnd.sample(names, min(100, len(names)))) for i in xrange(max(1, nq // 100))]
+    results["get_name_translator"] = bench(ncbi.get_name_translator, batches, 100)
+
+    print >>sys.stderr, "Benchmarking get_sp_lineage"
+    results["get_sp_lineage"] = bench(ncbi.get_sp_lineage, [rnd.choice(taxids) for i in xrange(nq)])
+
+    print >>sys.stderr, "Benchmarking get_topology"
+    sets = [rnd.sample(species, min(args.topology_size, len(species))) for i in xrange(args.topology_calls)]
+    results["get_topology"] = bench(ncbi.get_topology, sets, args.topology_size)
+
+    print >>sys.stderr, "Benchmarking annotate_tree"
+    trees = []
+    for taxa in sets:
+        t = ncbi.get_topology(taxa)
+        for leaf in t.iter_leaves():
+            leaf.add_feature("taxid", leaf.name)
+        trees.append(t)
+    results["annotate_tree"] = bench(ncbi.annotate_tree, trees, args.topology_size)
+
+    fuzzy_conn = load_fuzzy_connection(dbfile)
+    if fuzzy_conn:
+        print >>sys.stderr, "Benchmarking get_fuzzy_name_translation"
+        ncbi.c = fuzzy_conn
+        queries = [mutate(rnd, rnd.choice(names)) for i in xrange(args.fuzzy_queries)]
+        results["get_fuzzy_name_translation"] = bench(
+            lambda name: ncbi.get_fuzzy_name_translation(name, 0.8, use_cache=False), queries)
+        ncbi.c = ncbi.LazyConnection(dbfile)
+    else:
+        print >>sys.stderr, "Skipping fuzzy search (sqlite extension loading not available)"
+
+    try:
+        import ncbi_consensus
+    except ImportError, e:
+        print >>sys.stderr, "Skipping ncbi_consensus (%s)" %e
+    else:
+        print >>sys.stderr, "Benchmarking ncbi_consensus subtree analysis"
+        ncbi_consensus.args = Namespace(show_tree=False, render=False)
+        gene_trees = []
+        for i in xrange(args.consensus_trees):
+            t = random_gene_tree(rnd, species[:args.topology_size], args.gene_tree_size)
+            ncbi_consensus.annotate_tree_with_taxa(t, None)
+            gene_trees.append(t)
+        results["analyze_subtrees"] = bench(
+            lambda t: ncbi_consensus.analyze_subtrees(t, t.split_by_dups()),
+            gene_trees, args.gene_tree_size)
+
+    if not args.workdir and not args.keep:
+        shutil.rmtree(workdir)
+    return results
+
+def git_commit():
+    try:
+        return subprocess.check_output(["git", "rev-parse", "--short", "HEAD"],
+                                       cwd=REPO_PATH, stderr=open(os.devnull, "w")).strip()
+    except (OSError, subprocess.CalledProcessError):
+        return "unknown"
+
+def print_report(results, previous=None):
+    header = ["operation", "calls", "items/s", "p50 ms", "p95 ms", "p99 ms", "RSS growth MB"]
+    if previous:
+        header += ["p50 change", "items/s change"]
+    print '\t'.join(header)
+    for op in sorted(results):
+        r = results[op]
+        row = [op, str(r["calls"]), "%0.1f" %r["throughput"], "%0.3f" %r["p50_ms"],
+               "%0.3f" %r["p95_ms"], "%0.3f" %r["p99_ms"], "%0.1f" %r["rss_growth_mb"]]
+        if previous:
+            old = previous.get(op)
+            if old and old["p50_ms"] and old["throughput"]:
+                row += ["%+0.1f%%" %(100.0 * (r["p50_ms"] / old["p50_ms"] - 1)),
+                        "%+0.1f%%" %(100.0 * (r["throughput"] / old["throughput"] - 1))]
+            else:
+                row += ["-", "-"]
+        print '\t'.join(row)
+
+if __name__ == "__main__":
+    parser = ArgumentParser(description="ncbi_query benchmark suite")
+    parser.add_argument("-n", "--nodes", dest="nodes", type=int, default=10000,
+                        help="Size of the synthetic taxonomy (10k to 10M nodes)")
+    parser.add_argument("--queries", dest="queries", type=int, default=1000,
+                        help="Number of name and lineage queries")
+    parser.add_argument("--topology_size", dest="topology_size", type=int, default=100,
+                        help="Number of taxa per get_topology call")
+    parser.add_argument("--topology_calls", dest="topology_calls", type=int, default=20)
+    parser.add_argument("--fuzzy_queries", dest="fuzzy_queries", type=int, default=20)
+    parser.add_argument("--consensus_trees", dest="consensus_trees", type=int, default=5)
+    parser.add_argument("--gene_tree_size", dest="gene_tree_size", type=int, default=500)
+    parser.add_argument("--seed", dest="seed", type=int, default=0)
+    parser.add_argument("--workdir", dest="workdir", type=str,
+                        help="Directory for the taxdump and DB (default: temporary)")
+    parser.add_argument("--skip_update", dest="skip_update", action="store_true",
+                        help="Reuse the DB already present in --workdir")
+    parser.add_argument("--keep", dest="keep", action="store_true",
+                        help="Do not remove the temporary working directory")
+    parser.add_argument("--results_dir", dest="results_dir", type=str,
+                        default=os.path.join(BENCH_PATH, "results"),
+                        help="Where results are saved as JSON")
+    parser.add_argument("--compare", dest="compare", type=str,
+                        help="Previous results file to compare with")
+    args = parser.parse_args()
+
+    # progress messages printed by the benchmarked code go to stderr
+    stdout = sys.stdout
+    sys.stdout = sys.stderr
+    try:
+        results = run(args)
+    finally:
+        sys.stdout = stdout
+    commit = git_commit()
+    report = {"commit": commit,
+              "date": time.strftime("%Y-%m-%d %H:%M:%S"),
+              "nodes": args.nodes,
+              "results": results}
+    if not os.path.exists(args.results_dir):
+        os.makedirs(args.results_dir)
+    outfile = os.path.join(args.results_dir, "%s_%s_%d.json" %(time.strftime("%Y%m%d%H%M%S"),
+                                                                 commit, args.nodes))
+    json.dump(report, open(outfile, "w"), indent=2, sort_keys=True)
+
+    previous = json.load(open(args.compare))["results"] if args.compare else None
+    print_report(results, previous)
+    print >>sys.stderr, "Results saved into", outfile
@@ -0,0 +1,92 @@
+#!/usr/bin/env python
+# Synthetic NCBI taxdump generator (nodes.dmp and names.dmp), used to
+# benchmark the package at different scales without downloading anything.
+#
+# Trees follow the NCBI rank hierarchy, with random "no rank" nodes in
+# between (so lineages are ~15-25 levels deep, as in the real taxonomy),
+# heavy tailed fan-out, strains below some species and synonyms for a
+# fraction of the names.
+import sys
+import os
+import random
+from argparse import ArgumentParser
+
+RANKS = ["superkingdom", "kingdom", "phylum", "class", "order", "family",
+         "genus", "species"]
+RANK_SUFFIX = {"phylum": "ota", "class": "ia", "order": "ales", "family": "idae"}
+NO_RANK_PROB = 0.6
+SYNONYM_PROB = 0.2
+LETTERS = "abcdefghijklmnopqrstuvwxyz"
+
+def random_word(rnd, min_len=4, max_len=11):
+    return "".join([rnd.choice(LETTERS) for i in xrange(rnd.randint(min_len, max_len))])
+
+def fan_out(rnd, mean):
+    # Pareto distributed number of children with the given mean
+    alpha = 1.5
+    value = (mean * (alpha - 1) / alpha) * rnd.paretovariate(alpha)
+    return max(1, min(int(value), 5000))
+
+def generate_taxdump(outdir, nnodes, seed=0):
+    rnd = random.Random(seed)
+    # Mean fan-out so that the last rank reaches nnodes
+    mean = max(2.0, nnodes ** (1.0 / len(RANKS)))
+    NODES = open(os.path.join(outdir, "nodes.dmp"), "w")
+    NAMES = open(os.path.join(outdir, "names.dmp"), "w")
+    counter = [1]
+
+    def add_node(parent, rank, name):
+        taxid = counter[0]
+        counter[0] += 1
+        print >>NODES, "%s\t|\t%s\t|\t%s\t|\t\t|" %(taxid, parent, rank)
+        print >>NAMES, "%s\t|\t%s\t|\t\t|\tscientific name\t|" %(taxid, name)
+        if rank != "no rank" and rnd.random() < SYNONYM_PROB:
+            print >>NAMES, "%s\t|\t%s\t|\t\t|\tsynonym\t|" %(taxid, name.split()[0] + " " + random_word(rnd))
+        return taxid
+
+    root = add_node(1, "no rank", "root")
+    # (taxid, index of next rank, genus name). Clades are expanded depth
+    # first, so species are reached at any size, instead of spending the
+    # whole budget in the upper ranks.
+    pending = []
+    while counter[0] <= nnodes:
+        if not pending:
+            # more top level clades until the requested size is reached
+            pending.append((root, 0, None))
+        parent, rank_index, genus = pending.pop()
+        rank = RANKS[rank_index]
+        for i in xrange(fan_out(rnd, mean)):
+            if counter[0] > nnodes:
+                break
+            if rank == "species":
+                name = "%s %s" %(genus, random_word(rnd))
+                taxid = add_node(parent, rank, name)
+                # strains
+                for j in xrange(fan_out(rnd, 1.2) - 1):
+                    if counter[0] > nnodes:
+                        break
+                    add_node(taxid, "no rank", "%s str. %s%d" %(name, random_word(rnd, 2, 3).upper(), j))
+                continue
+            # unranked clades in between ranks
+            node = parent
+            while rank_index > 0 and rnd.random() < NO_RANK_PROB and counter[0] <= nnodes:
+                node = add_node(node, "no rank", random_word(rnd).capitalize())
+            name = random_word(rnd).capitalize() + RANK_SUFFIX.get(rank, "")
+            taxid = add_node(node, rank, name)
+            if rank == "genus":
+                genus = name
+            pending.append((taxid, rank_index + 1, genus))
+    NODES.close()
+    NAMES.close()
+    return counter[0] - 1
+
+if __name__ == "__main__":
+    parser = ArgumentParser(description="Generates a synthetic NCBI taxdump")
+    parser.add_argument("-n", "--nodes", dest="nodes", type=int, default=10000,
+                        help="Approximate number of nodes")
+    parser.add_argument("-o", "--outdir", dest="outdir", type=str, default=".",
+                        help="Where nodes.dmp and names.dmp are written")
+    parser.add_argument("--seed", dest="seed", type=int, default=0)
+    args = parser.parse_args()
+    total = generate_taxdump(args.outdir, args.nodes, args.seed)
+    print >>sys.stderr, total, "nodes written into", args.outdir
@@ -0,0 +1,112 @@
+# Precomputed keys used to index taxon names. update_taxadb.py stores them
+# next to every name in the DB and ncbi_query.py computes the same keys for
+# the query, so both sides must always use these functions. Keys are always
+# computed over the UTF-8 encoded name, as stored in the DB.
+
+import re
+
+# q-gram size and number of bits of the q-gram signature. Signatures are
+# kept below 2^63 so they fit into a (signed) SQLite INTEGER.
+QGRAM_SIZE = 2
+QGRAM_BITS = 63
+
+# Tokens that start an unranked/strain designation. Everything from them to
+# the end of the name can be dropped by normalize_name().
+STRAIN_MARKERS = set(["sp", "sp.", "spp", "spp.", "str", "str.", "strain",
+                      "isolate", "clone", "cf.", "aff."])
+# Words joining or preceding author names in citations
+AUTHOR_LINKS = set(["&", "and", "et", "al.", "ex", "in", "de", "van", "von", "d'"])
+
+# Completions of prefixes shared by more than PREFIX_SCAN_SIZE names are
+# precomputed, keeping the PREFIX_TOP_SIZE best ranked names of each prefix
+# and rank. Shorter lists are sorted at query time.
+PREFIX_SCAN_SIZE = 1000
+PREFIX_TOP_SIZE = 20
+
+_SPACES = re.compile(r"\s+")
+_BRACKETS = re.compile(r"[\[\]\(\)\{\}]")
+_YEAR = re.compile(r"^\d{4}[a-z]?$")
+# Author surnames in citations. Serotype and strain codes ("O157", "K-12",
+# "TIGR4") never match.
+_AUTHOR = re.compile(r"^[A-Z][a-z][a-z'-]*\.?$")
+_TRAILING_GROUP = re.compile(r"\(([^()]*)\)\s*$")
+
+def _utf8(name):
+    if isinstance(name, unicode):
+        return name.encode("utf8")
+    return name
+
+def _citation_start(tokens):
+    # Position where a trailing author citation starts in tokens, or None.
+    # Citations are author names followed by a year ("Linnaeus, 1758",
+    # "Smith et al. 1990", "de Candolle, 1820").
+    if not tokens or not _YEAR.match(tokens[-1]):
+        return None
+    start = None
+    for i in xrange(len(tokens) - 2, -1, -1):
+        tok = tokens[i].rstrip(",")
+        if _AUTHOR.match(tok) or (tok in AUTHOR_LINKS and start is not None):
+            start = i
+        elif tok not in AUTHOR_LINKS:
+            break
+    return start
+
+def normalize_name(name, strip_strains=True):
+    # Formatting-insensitive form of a taxon name: underscores, brackets and
+    # extra whitespace are ignored, and trailing author citations are
+    # removed ("Mus_musculus (Linnaeus, 1758)" -> "mus musculus"). If
+    # strip_strains is True, "sp." and strain suffixes are removed too
+    # ("Aus bus str. X" -> "aus bus"). Serovar, serotype and strain names
+    # not introduced by STRAIN_MARKERS are always kept ("Escherichia coli
+    # O157 H7"). Names are stored in the DB with their strain suffixes.
+    name = _utf8(name).replace("_", " ")
+    group = _TRAILING_GROUP.search(name)
+    if group and _citation_start(group.group(1).split()) == 0:
+        name = name[:group.start()]
+    tokens = _BRACKETS.sub(" ", name).split()
+    if strip_strains:
+        for i, tok in enumerate(tokens):
+            if i and tok.lower() in STRAIN_MARKERS:
+                tokens = tokens[:i]
+                break
+    # Author citations can only follow a lowercase epithet
+    if len(tokens) > 2 and tokens[1][:1].islower():
+        start = _citation_start(tokens)
+        if start is not None and start >= 2:
+            tokens = tokens[:start]
+    return " ".join(tokens).lower()
+
+def prefix_key(name):
+    # Case and whitespace insensitive key used by the autocomplete index. A
+    # trailing space is kept, so "homo " does not complete "Homologous".
+    return _SPACES.sub(" ", _utf8(name).lower()).lstrip()
+
+def name_length(name):
+    # Levenshtein extension works on raw bytes, so does the length filter
+    return len(_utf8(name))
+
+def genus_token(name):
+    tokens = _utf8(name).split(None, 1)
+    if tokens:
+        return tokens[0].lower()
+    return ""
+
+def qgrams(name):
+    padded = "^%s$" %_utf8(name).lower()
+    return set([padded[i:i+QGRAM_SIZE]
+                for i in xrange(len(padded) - QGRAM_SIZE + 1)])
+
+def qgram_signature(name):
+    sig = 0
+    for gram in qgrams(name):
+        sig |= 1 << ((ord(gram[0]) * 131 + ord(gram[1])) % QGRAM_BITS)
+    return sig
+
+def qgram_misses(sig1, sig2):
+    # Number of q-gram signature bits present in only one of the two
+    # names. Every edit operation can remove at most QGRAM_SIZE distinct
+    # q-grams from either name, so two names within k edits can never
+    # differ in more than k*QGRAM_SIZE bits on each side.
+    only1 = bin(sig1 & ~sig2).count("1")
+    only2 = bin(sig2 & ~sig1).count("1")
+    return max(only1, only2)
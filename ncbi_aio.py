@@ -0,0 +1,150 @@
+# asyncio API for ncbi_query (Python 3).
+#
+# ncbi_query and its sqlite work run in the query daemon ('ncbi_query.py
+# serve'), which acts as the dedicated executor. This module only keeps a
+# bounded pool of connections to it, so event loops never block on DB
+# lookups, and as many lookups as connections in the pool can be in flight
+# at once (the daemon coalesces them into set queries). Cancelling a pending
+# call discards its connection, so the pool never gets out of sync.
+#
+#   from ncbi_aio import get_lineages, get_name_translator
+#   name2taxid = await get_name_translator(["Homo sapiens"])
+#   lineages = await get_lineages(name2taxid.values())
+#
+# Results are decoded from JSON, so dictionary keys are always strings.
+import asyncio
+import json
+import os
+import weakref
+
+# Same defaults as ncbi_client.py
+DEFAULT_ADDRESS = os.path.join(os.path.split(os.path.realpath(__file__))[0],
+                               "ncbi_query.sock")
+
+def parse_address(address):
+    # "host:port" for TCP connections, anything else is a Unix socket path
+    host, sep, port = address.rpartition(":")
+    if sep and port.isdigit() and "/" not in address:
+        return (host or "127.0.0.1", int(port))
+    return address
+
+class AsyncQueryClient(object):
+    # `pool_size` is the maximum number of concurrent requests (and open
+    # connections). If `timeout` is given, calls taking longer than that
+    # (in seconds, including the time waiting for a free connection) raise
+    # asyncio.TimeoutError.
+    def __init__(self, address=DEFAULT_ADDRESS, pool_size=8, timeout=None):
+        self.address = parse_address(address)
+        self.timeout = timeout
+        self._slots = asyncio.Semaphore(pool_size)
+        self._idle = []
+
+    async def _connect(self):
+        if isinstance(self.address, tuple):
+            return await asyncio.open_connection(*self.address)
+        return await asyncio.open_unix_connection(self.address)
+
+    async def _call(self, request):
+        async with self._slots:
+            if self._idle:
+                reader, writer = self._idle.pop()
+            else:
+                reader, writer = await self._connect()
+            try:
+                writer.write(request)
+                await writer.drain()
+                line = await reader.readline()
+            except BaseException:
+                # cancelled or broken while a response was pending
+                writer.close()
+                raise
+            if not line:
+                writer.close()
+                raise IOError("Connection closed by the query daemon")
+            self._idle.append((reader, writer))
+        return line
+
+    async def call(self, method, *args, **kargs):
+        request = json.dumps({"method": method, "args": args, "kwargs": kargs})
+        call = self._call(request.encode("utf8") + b"\n")
+        if self.timeout is not None:
+            line = await asyncio.wait_for(call, self.timeout)
+        else:
+            line = await call
+        response = json.loads(line.decode("utf8"))
+        if "error" in response:
+            raise RuntimeError(response["error"])
+        return response["result"]
+
+    async def get_lineages(self, taxids):
+        return await self.call("get_lineage_translator", list(taxids))
+
+    async def get_sp_lineage(self, taxid):
+        return await self.call("get_sp_lineage", taxid)
+
+    async def get_name_translator(self, names):
+        return await self.call("get_name_translator", list(names))
+
+    async def get_taxid_translator(self, taxids):
+        return await self.call("get_taxid_translator", list(taxids))
+
+    async def get_ranks(self, taxids):
+        return await self.call("get_ranks", list(taxids))
+
+    async def get_topology(self, taxids, intermediate_nodes=False, rank_limit=None):
+        # extended newick string, with taxids as node names
+        return await self.call("get_topology", list(taxids), intermediate_nodes, rank_limit)
+
+    async def get_fuzzy_name_candidates(self, name, sim=0.9, limit=5, timeout=None):
+        return await self.call("get_fuzzy_name_candidates", name, sim, limit, timeout)
+
+    async def complete_name(self, prefix, limit=10, ranks=None):
+        return await self.call("complete_name", prefix, limit, ranks)
+
+    async def close(self):
+        while self._idle:
+            reader, writer = self._idle.pop()
+            writer.close()
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *exc_info):
+        await self.close()
+
+# Module level API, sharing a default client per event loop. Connections
+# and the pool semaphore are bound to the loop they were created in, so
+# each asyncio.run() gets its own client.
+_clients = weakref.WeakKeyDictionary()
+
+def get_client():
+    loop = asyncio.get_running_loop()
+    # idle connections keep a reference to their loop, so clients of
+    # finished loops are dropped here
+    for old in [old for old in _clients.keys() if old.is_closed()]:
+        del _clients[old]
+    client = _clients.get(loop)
+    if client is None:
+        client = _clients[loop] = AsyncQueryClient()
+    return client
+
+async def get_lineages(taxids):
+    return await get_client().get_lineages(taxids)
+
+async def get_sp_lineage(taxid):
+    return await get_client().get_sp_lineage(taxid)
+
+async def get_name_translator(names):
+    return await get_client().get_name_translator(names)
+
+async def get_taxid_translator(taxids):
+    return await get_client().get_taxid_translator(taxids)
+
+async def get_ranks(taxids):
+    return await get_client().get_ranks(taxids)
+
+async def get_topology(taxids, intermediate_nodes=False, rank_limit=None):
+    return await get_client().get_topology(taxids, intermediate_nodes, rank_limit)
+
+async def complete_name(prefix, limit=10, ranks=None):
+    return await get_client().complete_name(prefix, limit, ranks)
@@ -0,0 +1,151 @@
+#!/usr/bin/env python
+import sys
+import os
+import json
+import socket
+from argparse import ArgumentParser
+from string import strip
+
+__DESCRIPTION__ = """
+Query ncbi taxonomy through a running 'ncbi_query.py serve' daemon
+"""
+
+# Unix socket used by default by both the daemon and the client
+DEFAULT_ADDRESS = os.path.join(os.path.split(os.path.realpath(__file__))[0],
+                               "ncbi_query.sock")
+
+def parse_address(address):
+    # "host:port" for TCP connections, anything else is a Unix socket path
+    host, sep, port = address.rpartition(":")
+    if sep and port.isdigit() and "/" not in address:
+        return socket.AF_INET, (host or "127.0.0.1", int(port))
+    return socket.AF_UNIX, address
+
+class QueryClient(object):
+    # Thin client for the query daemon. Any ncbi_query function exposed by
+    # the daemon can be called as a method, i.e. client.get_sp_lineage(9606).
+    # Results are decoded from JSON, so dictionary keys are always strings.
+    def __init__(self, address=DEFAULT_ADDRESS):
+        family, addr = parse_address(address)
+        self.sock = socket.socket(family, socket.SOCK_STREAM)
+        self.sock.connect(addr)
+        self.rfile = self.sock.makefile("rb")
+        self.wfile = self.sock.makefile("wb")
+
+    def call(self, method, *args, **kargs):
+        request = {"method": method, "args": args, "kwargs": kargs}
+        self.wfile.write(json.dumps(request) + "\n")
+        self.wfile.flush()
+        line = self.rfile.readline()
+        if not line:
+            raise IOError("Connection closed by the query daemon")
+        response = json.loads(line)
+        if "error" in response:
+            raise RuntimeError(response["error"])
+        return response["result"]
+
+    def __getattr__(self, method):
+        if method.startswith("_"):
+            raise AttributeError(method)
+        return lambda *args, **kargs: self.call(method, *args, **kargs)
+
+    def close(self):
+        self.rfile.close()
+        self.wfile.close()
+        self.sock.close()
+
+def _encode(value):
+    if isinstance(value, unicode):
+        return value.encode("utf8")
+    return str(value)
+
+if __name__ == "__main__":
+    parser = ArgumentParser(description=__DESCRIPTION__)
+
+    parser.add_argument("--server", dest="server", type=str,
+                        default=DEFAULT_ADDRESS,
+                        help=("Unix socket path or host:port of the query"
+                              " daemon (default: %s)" %DEFAULT_ADDRESS))
+
+    parser.add_argument("-t", "--taxid", dest="taxid", nargs="+",
+                        type=int,
+                        help="""taxids (space separated)""")
+
+    parser.add_argument("-tf", "--taxid_file", dest="taxid_file",
+                        type=str,
+                        help="""file containing a list of taxids (one per line)""")
+
+    parser.add_argument("-n", "--name", dest="names", nargs="+",
+                        type=str,
+                        help="""species or taxa names (comma separated)""")
+
+    parser.add_argument("-nf", "--names_file", dest="names_file",
+                        type=str,
+                        help="""file containing a list of names (one per line)""")
+
+    parser.add_argument("-x", "--taxonomy", dest="taxonomy",
+                        action="store_true",
+                        help=("returns a pruned version of the NCBI taxonomy"
+                              " tree containing target species"))
+
+    parser.add_argument("--rank_limit", dest="rank_limit",
+                        type=str,
+                        help=("When used, all nodes under the provided rank"
+                              " are discarded"))
+
+    parser.add_argument("--full_lineage", dest="full_lineage",
+                        action="store_true",
+                        help=("When used, topology is not pruned to avoid "
+                              " one-child-nodes, so the complete lineage"
+                              " track leading from root to tips is kept."))
+
+    parser.add_argument("-i", "--info", dest="info",
+                        action="store_true",
+                        help="""shows NCBI information about the species""")
+
+    parser.add_argument("--fuzzy", dest="fuzzy", type=float,
+                        help=("Tries a fuzzy (and SLOW) search for those"
+                              " species names that could not be translated"
+                              " into taxids. A float number must be provided"
+                              " indicating the minimum string similarity."))
+
+    parser.add_argument("--server_stats", dest="server_stats",
+                        action="store_true",
+                        help="Prints the daemon request batching metrics (JSON)")
+
+    args = parser.parse_args()
+    client = QueryClient(args.server)
+
+    if args.server_stats:
+        print json.dumps(client.stats(), indent=2, sort_keys=True)
+
+    all_names = set([])
+    all_taxids = []
+    if args.names_file:
+        all_names.update(map(strip, open(args.names_file, "rU").read().split("\n")))
+    if args.names:
+        all_names.update(map(strip, " ".join(args.names).split(",")))
+    all_names.discard("")
+    if all_names:
+        name2row = client.name_translation_rows(list(all_names), args.fuzzy)
+        for name in all_names:
+            print "\t".join(map(_encode, name2row[name.decode("utf8")]))
+
+    if args.taxid_file:
+        all_taxids.extend(map(strip, open(args.taxid_file, "rU").read().split("\n")))
+    if args.taxid:
+        all_taxids.extend(args.taxid)
+    all_taxids = set(map(str, all_taxids))
+    all_taxids.discard("")
+
+    if all_taxids and args.info:
+        id2row = client.taxid_info_rows(list(all_taxids))
+        for row in id2row.itervalues():
+            print "\t".join(map(_encode, row))
+        for notfound in all_taxids - set(id2row):
+            print >>sys.stderr, notfound, "NOT FOUND"
+
+    if all_taxids and args.taxonomy:
+        print client.get_topology([int(tax) for tax in all_taxids if tax.isdigit()],
+                                  args.full_lineage, args.rank_limit)
+    client.close()
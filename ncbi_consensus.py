@@ -4,6 +4,8 @@ import os
 import cPickle
 import numpy
 import time
+import hashlib
+import multiprocessing
 from string import strip
 from collections import defaultdict
 from argparse import ArgumentParser, RawDescriptionHelpFormatter
@@ -18,6 +20,10 @@ from ete_dev import PhyloTree, Tree, SVG_COLORS, faces, treeview, NodeStyle, Tre
    
 
 import ncbi_query as ncbi
+import profiling
+from rfdist import RFReference, LCAIndex
+from sptrees import iter_speciation_trees, sptree_children, RunningStats
+from analysis_io import save_analysis, Analysis
 
 __DESCRIPTION__ = ("Calculates the consensus of a tree with the NCBI taxonomy."
                    " The analysis can be visualized over the tree, in"
@@ -110,77 +116,114 @@ def ncbi_layout(node):
 
             
 
-def analyze_tracks(t, n2content):
-    counterdict = lambda: defaultdict(int)
-    node2track = defaultdict(counterdict)
-    taxcounter = defaultdict(int)
-    tax2name = {}
-    for node, leaves in n2content.iteritems():
-        if node.is_leaf():
-            for index, tax in enumerate(node.lineage):
-                taxcounter[tax] += 1
-                tax2name[tax] = node.named_lineage[index]
+def encode_tree(t):
+    # Compact (parents, lineages) version of a tree annotated with leaf
+    # lineages. Nodes are listed in postorder, parents[i] is the index of
+    # the parent of node i (-1 for the root) and lineages[i] is None for
+    # internal nodes.
+    nodes = list(t.traverse("postorder"))
+    node2index = dict([(node, i) for i, node in enumerate(nodes)])
+    parents = [-1 if node is t else node2index[node.up] for node in nodes]
+    lineages = [node.lineage if node.is_leaf() else None for node in nodes]
+    return parents, lineages
+
+def find_broken_taxa(parents, lineages):
+    # A taxon is broken (non monophyletic) if some node contains part, but
+    # not all, of its leaves mixed with leaves of other taxa. It is enough to
+    # look at the largest nodes whose leaves all share the taxon: it is
+    # broken unless all of them hang from the same parent node. As lineages
+    # are root-to-tip tracks, the taxa shared by all leaves under a node are
+    # the common prefix of their lineages, computed in a single postorder
+    # pass. Linear on the total length of the leaf lineages.
+    #
+    # Returns the sets of monophyletic and broken taxa.
+    # node index -> [lineage, length of the prefix shared by all its leaves]
+    common = [None] * len(parents)
+    for i, parent in enumerate(parents):
+        if lineages[i] is not None:
+            common[i] = [lineages[i], len(lineages[i])]
+        if parent < 0:
+            continue
+        # children are always visited before their parent
+        lineage, length = common[i]
+        if common[parent] is None:
+            common[parent] = [lineage, length]
         else:
-            for lf in leaves:
-                for index, tax in enumerate(lf.lineage):
-                    node2track[node][tax] += 1
-
-    mono = set(taxcounter.keys())
+            parent_lineage, parent_length = common[parent]
+            length = min(length, parent_length)
+            for j in xrange(length):
+                if lineage[j] != parent_lineage[j]:
+                    length = j
+                    break
+            common[parent][1] = length
+
+    all_taxa = set()
+    tax2parent = {}
     non_mono = set()
-    for node, taxa in node2track.iteritems():
-        for tax, num in taxa.iteritems():
-            if taxcounter[tax] != num and len(n2content[node]) != num:
-                if 0:
-                    print "max:", taxcounter[tax]
-                    print "in this node:", num
-                    print "node size:", len(n2content[node])
-                    print tax2name[tax]
-                    print "..."
-                    raw_input()
-                mono.discard(tax)
+    for i, parent in enumerate(parents):
+        lineage, length = common[i]
+        if lineages[i] is not None:
+            all_taxa.update(lineage)
+        parent_length = common[parent][1] if parent >= 0 else 0
+        for tax in lineage[parent_length:length]:
+            if tax2parent.setdefault(tax, parent) != parent:
                 non_mono.add(tax)
+    return all_taxa - non_mono, non_mono
+
+@profiling.timed
+def analyze_tracks(t, n2content):
+    tax2name = {}
+    for leaf in t.iter_leaves():
+        for index, tax in enumerate(leaf.lineage):
+            tax2name[tax] = leaf.named_lineage[index]
+    mono, non_mono = find_broken_taxa(*encode_tree(t))
     return mono, non_mono, tax2name
-    
 
+@profiling.timed
 def analyze_subtrees(t, subtrees, reft=None):
     ncbi_mistakes = 0
     valid_subtrees = 0
-    broken_groups = set()
-    correct_groups = set()
     broken_subtrees = 0
     total_rf = 0
-    for count, subt in enumerate(subtrees):
+    valid = [subt for subt in subtrees if len(subt) > 1]
+    if args.show_tree or args.render:
+        # Subtree leaves are copies. They are mapped to the nodes of t by
+        # name (first match in levelorder, as t&name), and broken groups
+        # go to their common ancestor.
+        name2node = {}
+        for node in t.traverse("levelorder"):
+            name2node.setdefault(node.name, node)
+        lca_index = LCAIndex(t)
+    for count, subt in enumerate(valid):
         print "\r", count, "   ",
         sys.stdout.flush()
-        n2content = subt.get_node2content()
-        subt_size = len(n2content[subt])
-        if subt_size > 1:
-            valid_subtrees += 1
-            if reft:
-                for _n in n2content():
-                    if _n.is_leaf():
-                        _n.spcode = _n.realname
-                rf, rf_max = subt.robinson_foulds(reft, attr_t1="spcode")
-                total_rf += float(rf)/rf_max
-            
-            si, no, tax2name  = analyze_tracks(subt, n2content)
-            ncbi_mistakes += len(no)
-            if no:
-                broken_subtrees += 1
-            broken_groups.update(no)
-            correct_groups.update(si)
-            children = []
-            if args.show_tree or args.render:
-                for tip in subt.iter_leaves():
-                    target = (t&tip.name)
-                    children.append(target)
-                    target.broken_groups = set(no)
-                # Annotate node
-                source_node = t.get_common_ancestor(children)
-                source_node.broken_groups = set([tax2name[e] for e in no])
+        valid_subtrees += 1
+        si, no = find_broken_taxa(*encode_tree(subt))
+        if reft:
+            rf, rf_max = reft.robinson_foulds(subt, attr_t1="realname")[:2]
+            total_rf += float(rf)/rf_max
+
+        ncbi_mistakes += len(no)
+        if no:
+            broken_subtrees += 1
+        children = []
+        if args.show_tree or args.render:
+            tax2name = {}
+            for tip in subt.iter_leaves():
+                target = name2node[tip.name]
+                children.append(target)
+                target.broken_groups = set(no)
+                tax2name.update(zip(tip.lineage, tip.named_lineage))
+            # Annotate node
+            source_node = lca_index.get_common_ancestor(children)
+            source_node.broken_groups = set([tax2name[e] for e in no])
     print "\nDone"
     return valid_subtrees, broken_subtrees, ncbi_mistakes, total_rf
 
+# ncbi.TaxInfoCache set by --tax_cache
+tax_cache = None
+
+@profiling.timed
 def annotate_tree_with_taxa(t, name2taxa_file, tax2name=None, tax2track=None):
     if name2taxa_file: 
         names2taxid = dict([map(strip, line.split("\t"))
@@ -196,23 +239,243 @@ def annotate_tree_with_taxa(t, name2taxa_file, tax2name=None, tax2track=None):
             not_found += 1
     if not_found:
         print "WARNING: %s nodes where not found within NCBI taxonomy!!" %not_found
-       
+
+    if tax_cache:
+        # only the translators of this tree are kept in memory
+        tax2name, tax2track = tax_cache.get_translators([n.taxid for n in t.iter_leaves()])
     return ncbi.annotate_tree(t, tax2name, tax2track)
 
     
-def tree_compare(t1, t2):
-    t2_c2node = {}
-    for n, content in t2.get_node2content().iteritems():
-        t2_c2node[frozenset([_c.name for _c in content])] = n
+def iter_clusters(t, name2index):
+    # Yields (node, cluster) in postorder, where cluster stands for the set
+    # of leaf names under node. Names are numbered by name2index (new ones
+    # are added), so clusters are bitsets, computed from those of the
+    # children. They are returned as (lowest bit, bitset >> lowest bit), so
+    # their size depends on how spread their names are, not on the size of
+    # the tree. Only the bitsets of unfinished nodes are kept.
+    pending = []
+    for node in t.traverse("postorder"):
+        if node.children:
+            bits = 0
+            for i in xrange(len(node.children)):
+                bits |= pending.pop()
+        else:
+            bits = 1 << name2index.setdefault(node.name, len(name2index))
+        pending.append(bits)
+        lowest = (bits & -bits).bit_length() - 1
+        yield node, (lowest, bits >> lowest)
 
-    for n, content in t1.get_node2content().iteritems():
-        named_content = frozenset([_c.name for _c in content])
-        if frozenset(named_content) not in t2_c2node:
+@profiling.timed
+def tree_compare(t1, t2):
+    # Nodes of t1 grouping a set of leaf names not found in any node of t2
+    # are marked as changed. Names are numbered in t2 postorder, so t2
+    # clusters are usually contiguous and compact.
+    name2index = {}
+    t2_clusters = set([cluster for n, cluster in iter_clusters(t2, name2index)])
+    for n, cluster in iter_clusters(t1, name2index):
+        if cluster not in t2_clusters:
             n.add_feature("changed", "yes")
         else:
             n.add_feature("changed", "no")
 
+
+# ref tree file -> RFReference
+_references = {}
+
+def load_reference(fname):
+    # Reference trees are parsed and indexed only once per process
+    if fname not in _references:
+        print "Reading ref tree from", fname
+        _references[fname] = RFReference(Tree(fname, format=1))
+    return _references[fname]
+
+def read_tree(tfile):
+    # Reads and roots a tree file
+    t = PhyloTree(tfile, sp_naming_function=None)
+    if args.outgroup:
+        if len(args.outgroup) == 1:
+            out = t & args.outgroup[0]
+        else:
+            out = t.get_common_ancestor(args.outgroup)
+            if set(out.get_leaf_names()) ^ set(args.outgroup):
+                raise ValueError("Outgroup is not monophyletic")
             
+        t.set_outgroup(out)
+    t.ladderize()
+    return t
+
+def process_tree_file(tfile, tax2name, tax2track):
+    # Reads, roots and analyzes a tree file. Returns the tree, its result
+    # row and the (updated) tax2name and tax2track translators.
+    print tfile
+    t = read_tree(tfile)
+
+    if args.ref_tree:
+        reft = load_reference(args.ref_tree)
+    else:
+        reft = None
+    
+    if args.tax_info:
+        tax2name, tax2track = annotate_tree_with_taxa(t, args.tax_info, tax2name, tax2track)
+        if args.dump_tax_info:
+            cPickle.dump(tax2track, open("tax2track.pkl", "w"))
+            cPickle.dump(tax2name, open("tax2name.pkl", "w"))
+            print "Tax info written into pickle files"
+    else:
+        for n in t.iter_leaves():
+            spcode = n.name
+            n.add_features(taxid=spcode)
+            n.add_features(species=spcode)
+        tax2name, tax2track = annotate_tree_with_taxa(t, None, tax2name, tax2track)
+            
+    # Split tree into species trees
+    #subtrees =  t.get_speciation_trees()
+    if not args.rf_only:
+        print "Calculating tree subparts..."
+        t1 = time.time()
+        if not args.is_sptree:
+            subtrees =  t.split_by_dups()
+            print "Subparts:", len(subtrees), time.time()-t1
+        else:
+            subtrees = [t]
+        valid_subtrees, broken_subtrees, ncbi_mistakes, total_rf = analyze_subtrees(t, subtrees)
+        print valid_subtrees, broken_subtrees, ncbi_mistakes, total_rf
+    else:
+        subtrees = []
+        valid_subtrees, broken_subtrees, ncbi_mistakes, total_rf = 0, 0, 0, 0
+        
+    ndups = 0
+    nsubtrees = len(subtrees)
+       
+    rf = 0
+    rf_max = 0
+    rf_std = 0
+    rf_med = 0
+    common_names = 0
+    max_size = 0
+    if reft and len(subtrees) == 1:
+        rf = reft.robinson_foulds(t, attr_t1="realname")
+        rf_max = rf[1]
+        rf = rf[0]
+        rf_med = rf
+        
+    elif reft:
+        print "Calculating avg RF..."
+        nsubtrees, ndups, sptrees = iter_speciation_trees(t, args.max_sptrees, args.sample_sptrees)
+        rf_stats = RunningStats()
+        rf_max = 0.0 # reft.robinson_foulds(reft)[1]
+        sum_size = 0.0
+        print nsubtrees, "subtrees", ndups, "duplications"
+        if args.max_sptrees and nsubtrees > args.max_sptrees:
+            print "Only %d of them are compared" %args.max_sptrees
+
+        for ii, (subt, leaves) in enumerate(sptrees):
+            print "\r%d" %ii,
+            sys.stdout.flush()
+            try:
+                partial_rf = reft.robinson_foulds(subt, attr_t1="taxid", children=sptree_children)
+            except ValueError:
+                pass
+            else:
+                sptree_size = len(set([n.taxid for n in leaves]))
+                sum_size += sptree_size
+                rf_stats.add((partial_rf[0]/float(partial_rf[1])) * sptree_size)
+                common_names = max(len(partial_rf[2] & partial_rf[3]), common_names)
+                max_size = max(max_size, sptree_size)
+                rf_max = max(rf_max, partial_rf[1])
+            #print  partial_rf[:2]
+        rf = numpy.float64(rf_stats.total) / float(sum_size) # Treeko dist
+        rf_std = rf_stats.std()
+        rf_med = rf_stats.median()
+
+    reftree_name = os.path.basename(args.ref_tree) if args.ref_tree else ""
+    iter_values = (os.path.basename(tfile), reftree_name, nsubtrees, ndups, broken_subtrees, ncbi_mistakes, rf, rf_med, rf_std, rf_max, common_names)
+    return t, iter_values, tax2name, tax2track
+
+def parse_shard(shard):
+    # "i/N" (1 <= i <= N) -> (i, N)
+    try:
+        index, total = map(int, shard.split("/"))
+    except ValueError:
+        raise ValueError("Invalid shard %s, i/N expected" %shard)
+    if not 1 <= index <= total:
+        raise ValueError("Invalid shard %s, i/N expected" %shard)
+    return index, total
+
+def select_shard(tree_files, index, total):
+    # Round robin split, so shards are balanced and deterministic
+    return [tfile for i, tfile in enumerate(tree_files) if i % total == index - 1]
+
+def file_hash(fname):
+    digest = hashlib.md5()
+    source = open(fname, "rb")
+    for chunk in iter(lambda: source.read(1 << 20), ""):
+        digest.update(chunk)
+    source.close()
+    return digest.hexdigest()
+
+def load_checkpoint(fname):
+    # Checkpoint files have one line per finished tree file: content hash,
+    # path and result line. Returns a path -> (hash, result line)
+    # dictionary. An incomplete last line (interrupted run) is removed, so
+    # new records can be appended.
+    done = {}
+    if os.path.exists(fname):
+        size = 0
+        for line in open(fname):
+            if not line.endswith("\n"):
+                break
+            size += len(line)
+            digest, tfile, result = line.rstrip("\n").split("\t", 2)
+            done[tfile] = (digest, result)
+        if size < os.path.getsize(fname):
+            CHECKPOINT = open(fname, "r+")
+            CHECKPOINT.truncate(size)
+            CHECKPOINT.close()
+    return done
+
+# Taxonomy translators of each worker process, reused across its trees
+_worker_taxonomy = {}
+
+def _init_worker(tax2name, tax2track):
+    global tax_cache
+    # sqlite connections cannot be shared with the parent process
+    ncbi.c = ncbi.LazyConnection(os.path.join(ncbi.module_path, "taxa.sqlite"))
+    if tax_cache:
+        tax_cache = ncbi.TaxInfoCache(tax_cache.fname)
+    if profiling.ENABLED:
+        ncbi.c = profiling.TracedConnection(ncbi.c)
+    # progress messages go to stderr, so they are not mixed with results
+    sys.stdout = sys.stderr
+    _worker_taxonomy["tax2name"] = tax2name
+    _worker_taxonomy["tax2track"] = tax2track
+
+def _process_tree_worker(tfile):
+    t, iter_values, tax2name, tax2track = process_tree_file(
+        tfile, _worker_taxonomy["tax2name"], _worker_taxonomy["tax2track"])
+    _worker_taxonomy["tax2name"] = tax2name
+    _worker_taxonomy["tax2track"] = tax2track
+    return tfile, iter_values
+
+def process_tree_files_parallel(tree_files, jobs, tax2name, tax2track, ordered=True):
+    # Yields (tree file, result row) pairs, processed by `jobs` worker
+    # processes. Workers start with the given translators (shared with the
+    # parent process on fork) and extend their own copy as needed. Rows are
+    # yielded in input order unless ordered is False.
+    pool = multiprocessing.Pool(jobs, _init_worker, (tax2name, tax2track))
+    try:
+        if ordered:
+            results = pool.imap(_process_tree_worker, tree_files)
+        else:
+            results = pool.imap_unordered(_process_tree_worker, tree_files)
+        for result in results:
+            yield result
+        pool.close()
+    finally:
+        pool.terminate()
+        pool.join()
+
+
 if __name__ == "__main__":
     parser = ArgumentParser(description=__DESCRIPTION__, 
                             formatter_class=RawDescriptionHelpFormatter)
@@ -237,11 +500,11 @@ if __name__ == "__main__":
 
     parser.add_argument("--dump", dest="dump",
                         action="store_true", 
-                        help="""Dump analysis""")
+                        help="""Dump analysis into ncbi_analysis.npz""")
 
     parser.add_argument("--explore", dest="explore",
                         type=str,
-                        help="""Reads a previously analyzed tree and visualize it""")
+                        help="""Reads a previously analyzed tree (--dump) and visualize it""")
     
     parser.add_argument("-t", "--tree", dest="target_tree",  nargs="+",
                         type=str, 
@@ -261,6 +524,17 @@ if __name__ == "__main__":
                         help="Uses ref tree to compute robinson foulds"
                         " distances of the different subtrees")
 
+    parser.add_argument("--max_sptrees", dest="max_sptrees", type=int, default=10000,
+                        help="Maximum number of species trees of each gene"
+                        " tree compared with --ref (0 for no limit). The first"
+                        " ones are used, unless --sample_sptrees is set.")
+
+    parser.add_argument("--sample_sptrees", dest="sample_sptrees", type=int,
+                        metavar="SEED",
+                        help="Compares a random sample of --max_sptrees species"
+                        " trees, drawn with the given seed, in families with"
+                        " more species trees than that")
+
     parser.add_argument("--rf-only", dest="rf_only",
                         action = "store_true",
                         help="Skip ncbi consensus analysis")
@@ -282,17 +556,78 @@ if __name__ == "__main__":
                         help="")
     parser.add_argument("--dump_tax_info", dest="dump_tax_info", action="store_true",
                         help="")
+    parser.add_argument("--tax_cache", dest="tax_cache", type=str,
+                        help="SQLite file caching the names and lineages of"
+                        " the taxids found in the trees (created if needed)."
+                        " It can be shared by concurrent runs, each one only"
+                        " reads the taxids it needs and adds the missing ones."
+                        " Entries are tied to the taxonomy DB build. Replaces"
+                        " the --tax2name, --tax2track and --dump_tax_info"
+                        " pickle files.")
+
+    parser.add_argument("--jobs", dest="jobs", type=int, default=1,
+                        help="Number of tree files processed in parallel."
+                        " Result lines are written in input order. Trees are"
+                        " not compared with the previous one, as that is"
+                        " only used by --show, --render and --dump, which are"
+                        " not available in this mode.")
+
+    parser.add_argument("--unordered", dest="unordered", action="store_true",
+                        help="With --jobs, writes result lines as soon as"
+                        " they are ready instead of in input order")
+
+    parser.add_argument("--checkpoint", dest="checkpoint", type=str,
+                        help="Records finished trees (content hash and result"
+                        " line) into this file. When restarting with the same"
+                        " file, trees already done and not modified since"
+                        " are not analyzed again, their previous result line"
+                        " is reported instead.")
+
+    parser.add_argument("--shard", dest="shard", type=str,
+                        help="i/N. Only processes the i-th of N deterministic"
+                        " parts of the tree list (1 <= i <= N), so runs can be"
+                        " split across nodes and their outputs merged")
+
+    parser.add_argument("--profile", dest="profile", action="store_true",
+                        help="Reports function timings, SQL statement counts,"
+                        " slow queries and a cProfile summary (stderr)")
+    parser.add_argument("--profile_json", dest="profile_json", type=str,
+                        help="Saves the --profile metrics as JSON into the"
+                        " given file")
     
     args = parser.parse_args()
+    if args.shard:
+        try:
+            shard = parse_shard(args.shard)
+        except ValueError, e:
+            parser.error(str(e))
+    if args.jobs > 1:
+        if args.show_tree or args.render or args.dump or args.dump_tax_info:
+            parser.error("--jobs cannot be used with --show, --render, --dump or --dump_tax_info")
+    if args.profile or args.profile_json:
+        import atexit
+        profiler = profiling.start_profiler()
+        atexit.register(profiling.stop_profiler, profiler, args.profile_json)
+        ncbi.c = profiling.TracedConnection(ncbi.c)
 
     reftree_name = os.path.basename(args.ref_tree) if args.ref_tree else ""
     if args.explore:
         print "Reading tree from file:", args.explore
-        t = cPickle.load(open(args.explore))
         ts = TreeStyle()
+        if args.explore.endswith(".pkl"):
+            # whole tree pickles written by previous versions
+            t = cPickle.load(open(args.explore))
+            ts.layout_fn = ncbi_layout
+        else:
+            analysis = Analysis(args.explore)
+            t = analysis.tree
+            def explore_layout(node):
+                # node data is loaded as nodes are drawn
+                analysis.annotate(node)
+                ncbi_layout(node)
+            ts.layout_fn = explore_layout
         ts.force_topology = True
         ts.show_leaf_name = False
-        ts.layout_fn = ncbi_layout 
         ts.mode = "r"
         t.show(tree_style=ts)
         print "dumping color config"
@@ -310,6 +645,30 @@ if __name__ == "__main__":
         target_trees = [line.strip() for line in open(args.tree_list_file)]
     if args.target_tree:
         target_trees += args.target_tree
+    if args.shard:
+        target_trees = select_shard(target_trees, *shard)
+
+    # path -> (hash, result line) of the trees finished in previous runs
+    done = {}
+    tree2hash = {}
+    CHECKPOINT = None
+    if args.checkpoint:
+        done = load_checkpoint(args.checkpoint)
+        for tfile in target_trees:
+            tree2hash[tfile] = file_hash(tfile)
+            if tfile in done and done[tfile][0] != tree2hash[tfile]:
+                del done[tfile]
+        print len(done), "trees already done in", args.checkpoint
+        CHECKPOINT = open(args.checkpoint, "a")
+
+    def write_result(tfile, iter_values):
+        line = '\t'.join(map(str, iter_values))
+        print >>OUT, line
+        OUT.flush()
+        if CHECKPOINT:
+            print >>CHECKPOINT, '\t'.join([tree2hash[tfile], tfile, line])
+            CHECKPOINT.flush()
+
     prev_tree = None
     if args.tax2name:
         tax2name = cPickle.load(open(args.tax2name))
@@ -321,142 +680,84 @@ if __name__ == "__main__":
     else:
         tax2track = {}
     print len(tax2track), len(tax2name)
+    if args.tax_cache:
+        tax_cache = ncbi.TaxInfoCache(args.tax_cache)
+    if args.ref_tree:
+        # indexed before forking, so it is shared by --jobs workers
+        load_reference(args.ref_tree)
     #header = "filename", "refname", "# subtrees", "# dups", "broken subtrees", "ncbi_mistakes", "RF", "avg RF", "RF std", "max RF", "")
     #print '\t'.join(header)
     header = ("Tree".center(50), "Total subtrees", "Broken subtrees", "Broken NCBI clades", "RF (avg)", "RF (med)", "RF (std)", "RF (max possible)")
     print >>OUT, "#"+' '.join([h.center(15) for h in header])
-    for tfile in target_trees:
-        print tfile
-        t = PhyloTree(tfile, sp_naming_function=None)
-        if args.outgroup:
-            if len(args.outgroup) == 1:
-                out = t & args.outgroup[0]
-            else:
-                out = t.get_common_ancestor(args.outgroup)
-                if set(out.get_leaf_names()) ^ set(args.outgroup):
-                    raise ValueError("Outgroup is not monophyletic")
-                
-            t.set_outgroup(out)
-        t.ladderize()
-
-        if prev_tree:
-            tree_compare(t, prev_tree)
-        prev_tree = t
-        
-        if args.ref_tree:
-            print "Reading ref tree from", args.ref_tree
-            reft = Tree(args.ref_tree, format=1)
-
+    if args.jobs > 1:
+        pending = [tfile for tfile in target_trees if tfile not in done]
+        results = process_tree_files_parallel(pending, args.jobs, tax2name, tax2track,
+                                              not args.unordered)
+        if args.unordered:
+            for tfile in target_trees:
+                if tfile in done:
+                    print >>OUT, done[tfile][1]
+            for tfile, iter_values in results:
+                write_result(tfile, iter_values)
         else:
-            reft = None
-        
-        if args.tax_info:
-            tax2name, tax2track = annotate_tree_with_taxa(t, args.tax_info, tax2name, tax2track)
-            if args.dump_tax_info:
-                cPickle.dump(tax2track, open("tax2track.pkl", "w"))
-                cPickle.dump(tax2name, open("tax2name.pkl", "w"))
-                print "Tax info written into pickle files"
-        else:
-            for n in t.iter_leaves():
-                spcode = n.name
-                n.add_features(taxid=spcode)
-                n.add_features(species=spcode)
-            tax2name, tax2track = annotate_tree_with_taxa(t, None, tax2name, tax2track)
-                
-        # Split tree into species trees
-        #subtrees =  t.get_speciation_trees()
-        if not args.rf_only:
-            print "Calculating tree subparts..."
-            t1 = time.time()
-            if not args.is_sptree:
-                subtrees =  t.split_by_dups()
-                print "Subparts:", len(subtrees), time.time()-t1
-            else:
-                subtrees = [t]
-            valid_subtrees, broken_subtrees, ncbi_mistakes, total_rf = analyze_subtrees(t, subtrees)
-            print valid_subtrees, broken_subtrees, ncbi_mistakes, total_rf
-        else:
-            subtrees = []
-            valid_subtrees, broken_subtrees, ncbi_mistakes, total_rf = 0, 0, 0, 0
-            
-        ndups = 0
-        nsubtrees = len(subtrees)
-           
-        rf = 0
-        rf_max = 0
-        rf_std = 0
-        rf_med = 0
-        common_names = 0
-        max_size = 0
-        if reft and len(subtrees) == 1:
-            rf = t.robinson_foulds(reft, attr_t1="realname")
-            rf_max = rf[1]
-            rf = rf[0]
-            rf_med = rf
-            
-        elif reft:
-            print "Calculating avg RF..."
-            nsubtrees, ndups, subtrees = t.get_speciation_trees(map_features=["taxid"])
-            #print len(subtrees), "Sub-Species-trees found"
-            avg_rf = []
-            rf_max = 0.0 # reft.robinson_foulds(reft)[1]
-            sum_size = 0.0
-            print nsubtrees, "subtrees", ndups, "duplications"
-
-            for ii, subt in enumerate(subtrees):
-                print "\r%d" %ii,
-                sys.stdout.flush()
-                try:
-                    partial_rf = subt.robinson_foulds(reft, attr_t1="taxid")
-                except ValueError:
-                    pass
+            for tfile in target_trees:
+                if tfile in done:
+                    print >>OUT, done[tfile][1]
                 else:
-                    sptree_size = len(set([n.taxid for n in subt.iter_leaves()]))
-                    sum_size += sptree_size
-                    avg_rf.append((partial_rf[0]/float(partial_rf[1])) * sptree_size)
-                    common_names = max(len(partial_rf[2] & partial_rf[3]), common_names)
-                    max_size = max(max_size, sptree_size)
-                    rf_max = max(rf_max, partial_rf[1])
-                #print  partial_rf[:2]
-            rf = numpy.sum(avg_rf) / float(sum_size) # Treeko dist
-            rf_std = numpy.std(avg_rf)
-            rf_med = numpy.median(avg_rf)
-
-        iter_values = (os.path.basename(tfile), reftree_name, nsubtrees, ndups, broken_subtrees, ncbi_mistakes, rf, rf_med, rf_std, rf_max, common_names)
-        print >>OUT, '\t'.join(map(str, iter_values))
-        OUT.flush()
-        if args.show_tree or args.render:
-            ts = TreeStyle()
-            ts.force_topology = True
-            #ts.tree_width = 500
-            ts.show_leaf_name = False
-            ts.layout_fn = ncbi_layout 
-            ts.mode = "r"
-            t.dist = 0
-            if args.show_tree:
-                #if args.hide_monophyletic:
-                #    tax2monophyletic = {}
-                #    n2content = t.get_node2content()
-                #    for node in t.traverse():
-                #        term2count = defaultdict(int)
-                #        for leaf in n2content[node]:
-                #            if leaf.lineage:
-                #                for term in leaf.lineage:
-                #                    term2count[term] += 1
-                #        expected_size = len(n2content)
-                #        for term, count in term2count.iteritems():
-                #            if count > 1
+                    write_result(*results.next())
+            OUT.flush()
+    else:
+        prev_file = None
+        for tfile in target_trees:
+            if tfile in done:
+                print >>OUT, done[tfile][1]
+                prev_tree = None
+                prev_file = tfile
+                continue
+            t, iter_values, tax2name, tax2track = process_tree_file(tfile, tax2name, tax2track)
+            if prev_tree is None and prev_file:
+                # resumed after a checkpointed tree. Only its topology is
+                # needed, so it is not analyzed again.
+                prev_tree = read_tree(prev_file)
+            if prev_tree:
+                tree_compare(t, prev_tree)
+            prev_tree = t
+            prev_file = tfile
+            write_result(tfile, iter_values)
+            if args.show_tree or args.render:
+                ts = TreeStyle()
+                ts.force_topology = True
+                #ts.tree_width = 500
+                ts.show_leaf_name = False
+                ts.layout_fn = ncbi_layout 
+                ts.mode = "r"
+                t.dist = 0
+                if args.show_tree:
+                    #if args.hide_monophyletic:
+                    #    tax2monophyletic = {}
+                    #    n2content = t.get_node2content()
+                    #    for node in t.traverse():
+                    #        term2count = defaultdict(int)
+                    #        for leaf in n2content[node]:
+                    #            if leaf.lineage:
+                    #                for term in leaf.lineage:
+                    #                    term2count[term] += 1
+                    #        expected_size = len(n2content)
+                    #        for term, count in term2count.iteritems():
+                    #            if count > 1
                     
-                print "Showing tree..."
-                t.show(tree_style=ts)
-            else:
-                t.render("img.svg", tree_style=ts, dpi=300)
-            print "dumping color config"
-            cPickle.dump(name2color, open("ncbi_colors.pkl", "w"))
+                    print "Showing tree..."
+                    t.show(tree_style=ts)
+                else:
+                    t.render("img.svg", tree_style=ts, dpi=300)
+                print "dumping color config"
+                cPickle.dump(name2color, open("ncbi_colors.pkl", "w"))
 
-        if args.dump:
-            cPickle.dump(t, open("ncbi_analysis.pkl", "w"))
+            if args.dump:
+                save_analysis(t, "ncbi_analysis.npz")
                 
+    if CHECKPOINT:
+        CHECKPOINT.close()
     if args.output:
         OUT.close()
 
@@ -3,14 +3,17 @@ import sys
 import os
 from collections import defaultdict, deque
 from itertools import permutations
-from argparse import ArgumentParser
 from string import strip
 import logging as log
 
 import operator
 import sqlite3
 import math
-from ete2 import PhyloTree
+import time
+import profiling
+from profiling import timed
+from name_keys import (name_length, genus_token, qgram_signature, qgram_misses,
+                       normalize_name, prefix_key, QGRAM_SIZE, PREFIX_TOP_SIZE)
 
 paired_colors = ['#a6cee3',
                  '#1f78b4',
@@ -66,46 +69,267 @@ COLOR_RANKS = {
     }
 
 
+class LazyConnection(object):
+    # sqlite3 connection that is only opened when first used, so importing
+    # this module is (almost) free
+    def __init__(self, dbfile):
+        self._dbfile = dbfile
+        self._conn = None
+
+    def __getattr__(self, attr):
+        if self._conn is None:
+            self._conn = sqlite3.connect(self._dbfile)
+        return getattr(self._conn, attr)
+
 # Loads database
 module_path = os.path.split(os.path.realpath(__file__))[0]
-c = sqlite3.connect(os.path.join(module_path, 'taxa.sqlite'))
+c = LazyConnection(os.path.join(module_path, 'taxa.sqlite'))
+
+# Fuzzy search results are cached on disk and tagged with the DB build
+# version. The file can be set with the NCBI_FUZZY_CACHE environment variable
+# (or --fuzzy_cache), an empty value disables the cache.
+FUZZY_CACHE_FILE = os.environ.get("NCBI_FUZZY_CACHE", os.path.join(
+    os.environ.get("XDG_CACHE_HOME") or os.path.expanduser("~/.cache"),
+    "ncbi_taxonomy", "fuzzy_cache.sqlite"))
+_fuzzy_cache = None
 
 __DESCRIPTION__ = """ 
 Query ncbi taxonomy using a local DB
 """
 
-log.basicConfig(level=log.INFO, \
-                    format="%(levelname)s - %(message)s" )
+def _unicode(name):
+    # Byte strings cannot be bound to sqlite queries
+    if isinstance(name, str):
+        return name.decode("utf8")
+    return name
+
+def get_db_version():
+    try:
+        return c.execute('SELECT version FROM stats').fetchone()[0]
+    except Exception:
+        # DB created by an older update_taxadb.py
+        return None
+
+def _get_fuzzy_cache():
+    # Returns the (cache connection, DB version) pair, or None if the cache
+    # is disabled, cannot be opened or the current DB has no build version.
+    # Entries from other DB versions are dropped.
+    global _fuzzy_cache
+    if _fuzzy_cache is None:
+        _fuzzy_cache = False
+        version = get_db_version()
+        if version and FUZZY_CACHE_FILE:
+            try:
+                cache_dir = os.path.dirname(FUZZY_CACHE_FILE)
+                if cache_dir and not os.path.isdir(cache_dir):
+                    os.makedirs(cache_dir)
+                cache = sqlite3.connect(FUZZY_CACHE_FILE, timeout=30, check_same_thread=False)
+                cache.execute('CREATE TABLE IF NOT EXISTS fuzzy (version TEXT, query TEXT, sim REAL,'
+                              ' taxid INT, spname TEXT, score REAL, PRIMARY KEY (version, query, sim));')
+                cache.execute('DELETE FROM fuzzy WHERE version!=?;', (version,))
+                cache.commit()
+                _fuzzy_cache = (cache, version)
+            except (OSError, sqlite3.Error), e:
+                log.warning("Fuzzy search cache %s not available (%s), results will not be cached",
+                            FUZZY_CACHE_FILE, e)
+    return _fuzzy_cache or None
 
+class TaxInfoCache(object):
+    # On-disk cache of taxid names and lineages (the tax2name and tax2track
+    # translators used by annotate_tree), shared by concurrent processes.
+    # Entries are tagged with the DB build version and only added, never
+    # updated, so readers do not block each other and each process only
+    # looks up the taxids it needs. Entries from other DB versions are
+    # dropped when the cache is first used. Without a DB version, lookups
+    # go straight to the DB.
+    BATCH_SIZE = 500
 
+    def __init__(self, fname):
+        self.fname = fname
+        self._db = None
+        self.version = None
 
+    def _connect(self):
+        if self._db is None:
+            self.version = get_db_version()
+            if not self.version:
+                self._db = False
+                return None
+            db = sqlite3.connect(self.fname, timeout=60)
+            db.execute('PRAGMA journal_mode=WAL;')
+            db.execute('CREATE TABLE IF NOT EXISTS taxinfo (version TEXT, taxid INT, spname TEXT,'
+                       ' track TEXT, PRIMARY KEY (version, taxid));')
+            # range conditions use the primary key index, so this does not
+            # scan the whole cache
+            if db.execute('SELECT 1 FROM taxinfo WHERE version<? OR version>? LIMIT 1;',
+                          (self.version, self.version)).fetchone():
+                db.execute('DELETE FROM taxinfo WHERE version!=?;', (self.version,))
+            db.commit()
+            self._db = db
+        return self._db or None
 
-def get_fuzzy_name_translation(name, sim=0.9):
-    log.info("Trying fuzzy search for %s", name)
-    maxdiffs = math.ceil(len(name) * (1-sim))
-    cmd = 'SELECT taxid, spname, LEVENSHTEIN(spname, "%s") AS sim  FROM species WHERE sim<=%s ORDER BY sim LIMIT 1;' % (name, maxdiffs)
-    taxid, spname, score = None, None, len(name)
-    result = c.execute(cmd)
-    try:
-        taxid, spname, score = result.fetchone()
-    except TypeError:
-        cmd = 'SELECT taxid, spname, LEVENSHTEIN(spname, "%s") AS sim  FROM synonym WHERE sim<=%s ORDER BY sim LIMIT 1;' % (name, maxdiffs)
-        result = c.execute(cmd)
+    def _lookup(self, taxids):
+        # taxid -> (spname, lineage) for the given int taxids
+        db = self._connect()
+        tax2info = {}
+        if db:
+            taxids = list(taxids)
+            for i in xrange(0, len(taxids), self.BATCH_SIZE):
+                batch = taxids[i:i+self.BATCH_SIZE]
+                cmd = ('SELECT taxid, spname, track FROM taxinfo WHERE version=? AND taxid IN (%s);'
+                       %','.join(['?'] * len(batch)))
+                for tax, spname, track in db.execute(cmd, [self.version] + batch):
+                    tax2info[tax] = (spname, map(int, track.split(",")))
+        missing = set(taxids) - set(tax2info)
+        if missing:
+            id2name = get_taxid_translator(missing)
+            id2lineage = get_lineage_translator(missing)
+            rows = []
+            for tax in missing:
+                # unknown taxids get the same lineage as in get_sp_lineage()
+                lineage = id2lineage.get(tax, [1])
+                tax2info[tax] = (id2name.get(tax), lineage)
+                rows.append((self.version, tax, id2name.get(tax), ','.join(map(str, lineage))))
+            if db:
+                db.executemany('INSERT OR IGNORE INTO taxinfo VALUES (?, ?, ?, ?);', rows)
+                db.commit()
+        return tax2info
+
+    def get_translators(self, taxids):
+        # Returns the tax2name and tax2track translators of the given
+        # taxids, as expected by annotate_tree(). Unknown taxids are named
+        # "Unknown", as annotate_tree() does, so they are not queried again.
+        taxids = [tax for tax in taxids if tax]
+        tax2info = self._lookup(set([int(tax) for tax in taxids]))
+        tax2name = dict([(tax, spname if spname is not None else "Unknown")
+                         for tax, (spname, lineage) in tax2info.iteritems()])
+        tax2track = dict([(tax, tax2info[int(tax)][1]) for tax in taxids])
+        return tax2name, tax2track
+
+def _fuzzy_search(table, name, maxdiffs):
+    # Cheap pruning stages before any LEVENSHTEIN() call. Names in the same
+    # genus block are checked first, so a close hit there tightens the
+    # allowed distance for the full search. The full search only computes
+    # distances for names whose length and q-gram signature could still be
+    # within maxdiffs edits from the query.
+    qlen = name_length(name)
+    qsig = qgram_signature(name)
+    cmd = ('SELECT taxid, spname, LEVENSHTEIN(spname, ?) AS sim FROM %s'
+           ' WHERE genus=? AND namelen BETWEEN ? AND ? AND sim<=?'
+           ' ORDER BY sim, taxid LIMIT 1;' %table)
+    hit = c.execute(cmd, (name, _unicode(genus_token(name)), qlen-maxdiffs, qlen+maxdiffs,
+                          maxdiffs)).fetchone()
+    if hit:
+        maxdiffs = hit[2]
+        if maxdiffs == 0:
+            return hit
+
+    cmd = ('SELECT taxid, spname, LEVENSHTEIN(spname, ?) AS sim FROM %s'
+           ' WHERE namelen BETWEEN ? AND ? AND QGRAM_MISSES(qsig, ?)<=?'
+           ' AND sim<=? ORDER BY sim, taxid LIMIT 1;' %table)
+    return c.execute(cmd, (name, qlen-maxdiffs, qlen+maxdiffs, qsig,
+                           maxdiffs * QGRAM_SIZE, maxdiffs)).fetchone()
+
+@timed
+def get_fuzzy_name_translation(name, sim=0.9, use_cache=True):
+    name = _unicode(name)
+    cache = _get_fuzzy_cache() if use_cache else None
+    if cache:
+        db, version = cache
         try:
-            taxid, spname, score = result.fetchone()
-        except:
-            pass
-        else:
-            taxid = int(taxid)
-    else:
+            hit = db.execute('SELECT taxid, spname, score FROM fuzzy WHERE version=? AND query=? AND sim=?;',
+                             (version, name, sim)).fetchone()
+        except sqlite3.Error, e:
+            log.warning("Fuzzy search cache lookup failed (%s)", e)
+            hit = None
+        if hit:
+            log.info("Using cached fuzzy search for %s", name)
+            return hit
+
+    log.info("Trying fuzzy search for %s", name)
+    # LEVENSHTEIN() distances are in bytes, as the namelen column, so the
+    # allowed distance and the score are relative to the byte length too
+    qlen = name_length(name)
+    maxdiffs = int(math.ceil(qlen * (1-sim)))
+    c.create_function("QGRAM_MISSES", 2, qgram_misses)
+    taxid, spname, score = None, None, qlen
+    hit = _fuzzy_search("species", name, maxdiffs)
+    if not hit:
+        hit = _fuzzy_search("synonym", name, maxdiffs)
+    if hit:
+        taxid, spname, score = hit
         taxid = int(taxid)
 
-    norm_score = 1-(float(score)/len(name))
+    norm_score = 1-(float(score)/qlen)
     if taxid: 
         log.info("FOUND!                  %s taxid:%s score:%s (%s)", spname, taxid, score, norm_score)
 
+    # Negative results are cached too
+    if cache:
+        try:
+            db.execute('INSERT OR REPLACE INTO fuzzy VALUES (?, ?, ?, ?, ?, ?);',
+                       (version, name, sim, taxid, spname, norm_score))
+            db.commit()
+        except sqlite3.Error, e:
+            log.warning("Fuzzy search result for %s not cached (%s)", name, e)
     return taxid, spname, norm_score
     
+@timed
+def get_fuzzy_name_candidates(name, sim=0.9, limit=5, timeout=None):
+    # Top-k version of get_fuzzy_name_translation. Returns a list of up to
+    # `limit` (taxid, spname, score) tuples sorted by score, and a flag that
+    # is True if the time budget (in seconds) ran out before the search was
+    # complete. In such case, the best candidates found so far are returned.
+    #
+    # Names are scanned in chunks of increasing length difference to the
+    # query, so good candidates show up first and the allowed distance can
+    # be tightened as soon as `limit` taxa are found.
+    name = _unicode(name)
+    # distances in bytes, see get_fuzzy_name_translation()
+    qlen = name_length(name)
+    maxdiffs = int(math.ceil(qlen * (1-sim)))
+    qsig = qgram_signature(name)
+    c.create_function("QGRAM_MISSES", 2, qgram_misses)
+    deadline = None
+    if timeout is not None:
+        deadline = time.time() + timeout
+        c.set_progress_handler(lambda: time.time() > deadline, 1000)
+    tax2hit = {}
+    partial = False
+    try:
+        for diff in xrange(maxdiffs + 1):
+            if deadline and time.time() > deadline:
+                partial = True
+                break
+            cutoff = maxdiffs
+            if len(tax2hit) >= limit:
+                cutoff = sorted([h[0] for h in tax2hit.itervalues()])[limit-1]
+            if diff > cutoff:
+                break
+            for namelen in sorted(set([qlen-diff, qlen+diff])):
+                for table in ["species", "synonym"]:
+                    cmd = ('SELECT taxid, spname, LEVENSHTEIN(spname, ?) AS sim FROM %s'
+                           ' WHERE namelen=? AND QGRAM_MISSES(qsig, ?)<=? AND sim<=?;' %table)
+                    for taxid, spname, score in c.execute(cmd, (name, namelen, qsig,
+                                                                cutoff * QGRAM_SIZE, cutoff)):
+                        taxid = int(taxid)
+                        if taxid not in tax2hit or (score, spname) < tax2hit[taxid]:
+                            tax2hit[taxid] = (score, spname)
+    except sqlite3.OperationalError:
+        # progress handler interrupted the running query
+        if not deadline or time.time() <= deadline:
+            raise
+        partial = True
+    finally:
+        if deadline:
+            c.set_progress_handler(None, 1000)
+
+    hits = sorted([(score, taxid, spname) for taxid, (score, spname) in tax2hit.iteritems()])
+    candidates = [(taxid, spname, 1-(float(score)/qlen))
+                  for score, taxid, spname in hits[:limit]]
+    return candidates, partial
+
+@timed
 def get_sp_lineage(taxid):
     if not taxid:
         return None
@@ -117,6 +341,20 @@ def get_sp_lineage(taxid):
     track = map(int, raw_track[0].split(","))
     return list(reversed(track))
 
+@timed
+def get_lineage_translator(taxids):
+    # Batch version of get_sp_lineage
+    all_ids = set(taxids)
+    all_ids.discard(None)
+    all_ids.discard("")
+    query = ','.join(['"%s"' %v for v in all_ids])
+    result = c.execute('SELECT taxid, track FROM species WHERE taxid IN (%s);' %query)
+    id2lineage = {}
+    for tax, track in result.fetchall():
+        id2lineage[tax] = list(reversed(map(int, track.split(","))))
+    return id2lineage
+
+@timed
 def get_taxid_translator(taxids):
     all_ids = set(taxids)
     all_ids.discard(None)
@@ -129,6 +367,7 @@ def get_taxid_translator(taxids):
         id2name[tax] = spname
     return id2name
 
+@timed
 def get_ranks(taxids):
     all_ids = set(taxids)
     all_ids.discard(None)
@@ -141,9 +380,83 @@ def get_ranks(taxids):
         id2rank[tax] = spname
     return id2rank
 
-def get_name_translator(names):
+_table_columns = {}
+
+def table_columns(table):
+    # Column names of a DB table (empty for missing tables). DBs created by
+    # an older update_taxadb.py lack some of the current tables and columns.
+    if table not in _table_columns:
+        _table_columns[table] = set([row[1] for row in c.execute('PRAGMA table_info(%s);' %table)])
+    return _table_columns[table]
+
+def has_normalized_names():
+    return "normname" in table_columns("species")
+
+def _lookup_normalized_names(norm2names, name2id, name2realname):
+    # One lookup round of get_normalized_name_translator()
+    resolved = set()
+    keys = list(norm2names)
+    for table in ["species", "synonym"]:
+        for i in xrange(0, len(keys), 500):
+            chunk = [k for k in keys[i:i+500] if k not in resolved]
+            if not chunk:
+                continue
+            cmd = ('select normname, spname, taxid from %s where normname IN (%s)'
+                   ' ORDER BY LENGTH(spname) DESC, spname DESC' %(table, ','.join(['?'] * len(chunk))))
+            norm2hits = defaultdict(dict)
+            # last name of each taxid is the shortest one
+            for norm, sp, taxid in c.execute(cmd, chunk).fetchall():
+                norm2hits[norm][taxid] = sp
+            for norm, hits in norm2hits.iteritems():
+                resolved.add(norm)
+                if len(hits) > 1:
+                    # DBs from older versions stored keys without strain
+                    # suffixes. Taxa whose own name has no suffix win.
+                    hits = dict([(taxid, sp) for taxid, sp in hits.iteritems()
+                                 if _unicode(normalize_name(sp, strip_strains=False)) == norm])
+                if len(hits) != 1:
+                    log.info("Ambiguous normalized name %s", norm)
+                    continue
+                taxid, sp = hits.items()[0]
+                for oname in norm2names[norm]:
+                    name2id[oname] = taxid
+                    name2realname[oname] = sp
+
+@timed
+def get_normalized_name_translator(names):
+    # Resolves formatting variants of known names (see
+    # name_keys.normalize_name). Names are looked up with their strain
+    # suffixes first, so strains resolve to themselves, and without them
+    # otherwise ("Aus bus sp." -> "Aus bus"). Scientific names are tried
+    # before synonyms. Normalized names shared by several taxa are left
+    # unresolved, so they can go through fuzzy search instead. If a taxon
+    # has several matching names, the shortest one is reported.
     name2id = {}
     name2realname = {}
+    full_keys = {}
+    for strip_strains in [False, True]:
+        norm2names = defaultdict(list)
+        for n in names:
+            if n in name2id:
+                continue
+            key = _unicode(normalize_name(n, strip_strains))
+            if not strip_strains:
+                full_keys[n] = key
+            elif key == full_keys[n]:
+                continue
+            norm2names[key].append(n)
+        norm2names.pop("", None)
+        _lookup_normalized_names(norm2names, name2id, name2realname)
+    return name2id, name2realname
+
+@timed
+def get_name_translator(names, name2realname=None):
+    # Exact (case insensitive) name and synonym matches first, then
+    # normalized matches. If name2realname is provided, it is filled with
+    # the DB spelling of each translated name.
+    name2id = {}
+    if name2realname is None:
+        name2realname = {}
     name2origname = {}
     for n in names:
         name2origname[n.lower()] = n
@@ -162,9 +475,65 @@ def get_name_translator(names):
             oname = name2origname[sp.lower()]
             name2id[oname] = taxid
             name2realname[oname] = sp
+    missing =  names - set(name2id.keys())
+    if missing and has_normalized_names():
+        norm2id, norm2realname = get_normalized_name_translator(missing)
+        name2id.update(norm2id)
+        name2realname.update(norm2realname)
     return name2id
     
   
+@timed
+def complete_name(prefix, limit=10, ranks=None):
+    # Autocompletion of taxon names (scientific names and synonyms). Returns
+    # up to `limit` (taxid, spname, rank) tuples, one per taxid, ranked by
+    # clade size. Optionally, only taxa within the given ranks are reported.
+    key = _unicode(prefix_key(prefix))
+    if not key:
+        return []
+    rank_filter = ""
+    rank_args = []
+    if ranks:
+        rank_filter = " AND rank IN (%s)" %','.join(['?'] * len(ranks))
+        rank_args = list(ranks)
+
+    def collect(rows):
+        completions = []
+        visited = set()
+        for taxid, spname, rank in rows:
+            if taxid not in visited:
+                visited.add(taxid)
+                completions.append((taxid, spname, rank))
+                if len(completions) == limit:
+                    break
+        return completions
+
+    # Prefixes shared by many names have the best PREFIX_TOP_SIZE taxa of
+    # each rank precomputed. Ranks with fewer stored taxa are complete, and
+    # the stored taxa are enough for up to PREFIX_TOP_SIZE completions.
+    if "prefix" in table_columns("prefix_best"):
+        cmd = ('SELECT taxid, spname, rank FROM prefix_best WHERE prefix=?'
+               ' ORDER BY weight DESC, synonym, key;')
+        rows = c.execute(cmd, (key,)).fetchall()
+        if rows:
+            rank2count = defaultdict(int)
+            for taxid, spname, rank in rows:
+                rank2count[rank] += 1
+            if ranks:
+                rows = [r for r in rows if r[2] in ranks]
+            completions = collect(rows)
+            truncated = [rank for rank in set([r[2] for r in rows])
+                         if rank2count[rank] == PREFIX_TOP_SIZE]
+            if (len(completions) == limit and limit <= PREFIX_TOP_SIZE) or not truncated:
+                return completions
+
+    # Any name >= key and < upper shares the prefix
+    upper = key[:-1] + unichr(ord(key[-1]) + 1)
+    cmd = ('SELECT taxid, spname, rank FROM prefix WHERE key>=? AND key<?%s'
+           ' ORDER BY weight DESC, synonym, key;' %rank_filter)
+    return collect(c.execute(cmd, [key, upper] + rank_args))
+
+@timed
 def translate_to_names(taxids):
     def get_name(taxid):
         result = c.execute('select spname from species where taxid=%s' %taxid)
@@ -179,7 +548,13 @@ def translate_to_names(taxids):
     return names
 
     
-def get_topology(taxids, intermediate_nodes=False, rank_limit=None):
+@timed
+def get_topology(taxids, intermediate_nodes=False, rank_limit=None, collapse_subspecies=False):
+    # If collapse_subspecies is True, the nodes below the requested species
+    # are flattened too (see collapse_subspecies()). The CLI does it after
+    # naming the nodes instead, as collapsed nodes are tagged by name.
+    # ete2 is only imported when topologies are requested
+    from ete2 import PhyloTree
     sp2track = {}
     elem2node = {}
     for sp in taxids:
@@ -218,10 +593,52 @@ def get_topology(taxids, intermediate_nodes=False, rank_limit=None):
                 n.delete(prevent_nondicotomic=False)
        
     if len(root.children) == 1:
-        return root.children[0].detach()
+        t = root.children[0].detach()
     else:
-        return root
+        t = root
+    if collapse_subspecies:
+        _collapse_subspecies(t, set(map(int, taxids)))
+    return t
+
+@timed
+def collapse_subspecies(t, taxids):
+    # Flattens everything under the requested species nodes, so species and
+    # subspecies are seen as sister nodes: all descendants become leaves
+    # under the species node (in levelorder, tagged with their rank),
+    # followed by a copy of the species node itself. Nodes are identified by
+    # their taxid feature, or by their name if they have none (as returned
+    # by get_topology). Linear on the tree size.
+    stack = [t]
+    while stack:
+        node = stack.pop()
+        if not (node.children and node.rank == "species" and
+                int(getattr(node, "taxid", node.name)) in taxids):
+            stack.extend(reversed(node.children))
+            continue
+        below = []
+        pending = deque(node.children)
+        while pending:
+            n = pending.popleft()
+            below.append(n)
+            pending.extend(n.children)
+        # creates a copy of the species node
+        connector = node.__class__()
+        for f in node.features:
+            connector.add_feature(f, getattr(node, f))
+        connector.name = connector.name + "{species}"
+        connector.up = node
+        for n in below:
+            n.children = []
+            n.up = node
+            n.name = n.name + "{%s}" %n.rank
+        below.append(connector)
+        node.children = below
+        node.add_feature("collapse_subspecies", "1")
 
+# get_topology() argument shadows the function
+_collapse_subspecies = collapse_subspecies
+
+@timed
 def annotate_tree(t, tax2name=None, tax2track=None):
     leaves = t.get_leaves()
     taxids = set(map(int, [n.taxid for n in leaves]))
@@ -245,6 +662,146 @@ def annotate_tree(t, tax2name=None, tax2track=None):
         
     return tax2name, tax2track
 
+def load_fuzzy_extension():
+    # enable extension loading
+    c.enable_load_extension(True)
+    c.execute("select load_extension('%s')" % os.path.join(module_path,
+                                "SQLite-Levenshtein/levenshtein.sqlext"))
+
+@timed
+def name_translation_rows(names, fuzzy=None):
+    # CLI output (score, name, realname, taxid) for a set of names
+    name2realname = {}
+    name2score = {}
+    name2id = get_name_translator(names, name2realname)
+    not_found = names - set(name2id.keys())
+    if fuzzy and not_found:
+        log.info("%s unknown names", len(not_found))
+        for name in not_found:
+            tax, realname, sim = get_fuzzy_name_translation(name, fuzzy)
+            if tax:
+                name2id[name] = tax
+                name2realname[name] = realname
+                name2score[name] = "Fuzzy:%0.2f" %sim
+
+    name2row = {}
+    for name in names:
+        taxid = name2id.get(name, "???")
+        realname = name2realname.get(name, name)
+        if name in name2score:
+            score = name2score[name]
+        elif realname.lower() != name.lower():
+            score = "Normalized:1.0"
+        else:
+            score = "Exact:1.0"
+        name2row[name] = [score, name, realname.capitalize(), taxid]
+    return name2row
+
+@timed
+def taxid_info_rows(taxids):
+    # CLI output (taxid, name, named lineage, lineage) for a set of taxids.
+    # Unknown taxids are not reported.
+    translator = get_taxid_translator(taxids)
+    id2lineage = get_lineage_translator(translator.keys())
+    lineage_ids = set()
+    for lineage in id2lineage.itervalues():
+        lineage_ids.update(lineage)
+    id2name = get_taxid_translator(lineage_ids)
+    id2row = {}
+    for taxid, name in translator.iteritems():
+        lineage = id2lineage.get(taxid, [1])
+        named_lineage = ','.join([id2name.get(tax, "?") for tax in lineage])
+        id2row[taxid] = [taxid, name, named_lineage, ','.join(map(str, lineage))]
+    return id2row
+
+def iter_batches(source, batch_size):
+    # Non empty lines of source, in lists of up to batch_size elements
+    batch = []
+    for line in source:
+        line = line.strip()
+        if line:
+            batch.append(line)
+            if len(batch) == batch_size:
+                yield batch
+                batch = []
+    if batch:
+        yield batch
+
+def stream_name_translations(source, out, batch_size=1000, fuzzy=None):
+    # Translates one name per line, writing results in input order as soon
+    # as each batch is resolved.
+    for batch in iter_batches(source, batch_size):
+        name2row = name_translation_rows(set(batch), fuzzy)
+        for name in batch:
+            print >>out, "\t".join(map(str, name2row[name]))
+        out.flush()
+
+def stream_taxid_translations(source, out, batch_size=1000):
+    # Same as above, for taxids
+    for batch in iter_batches(source, batch_size):
+        id2row = taxid_info_rows([tax for tax in batch if tax.isdigit()])
+        for tax in batch:
+            if tax.isdigit() and int(tax) in id2row:
+                print >>out, "\t".join(map(str, id2row[int(tax)]))
+            else:
+                print >>sys.stderr, tax, "NOT FOUND"
+        out.flush()
+
+# Newick variants written by the --taxonomy option
+NEWICK_SUFFIXES = {"plain": ".nw",
+                   "named": ".named.nw",
+                   "extended": ".extended.nw",
+                   "taxids": ".taxids.nw"}
+NEWICK_VARIANTS = ["plain", "named", "extended", "taxids"]
+NEWICK_FEATURES = ["taxid", "name", "rank", "bgcolor", "sci_name", "collapse_subspecies"]
+
+def _newick_label(variant):
+    # label(node, is_leaf) functions for newick_io.write_newicks
+    from newick_io import safe_label, nhx
+    def _node_label(node):
+        return safe_label(node.name) or "NoName"
+    if variant == "plain":
+        return lambda n, is_leaf: _node_label(n) if is_leaf else ""
+    elif variant == "named":
+        return lambda n, is_leaf: _node_label(n)
+    elif variant == "extended":
+        def label(n, is_leaf):
+            features = nhx([(f, getattr(n, f)) for f in NEWICK_FEATURES if hasattr(n, f)])
+            return _node_label(n) + features if is_leaf else features
+        return label
+    elif variant == "taxids":
+        return lambda n, is_leaf: (safe_label(n.taxid) or "NoName") if is_leaf else ""
+
+def write_taxonomy_newicks(t, variants=NEWICK_VARIANTS, prefix="your_ncbi_query", compress=False):
+    # Writes the selected newick variants of a --taxonomy tree in a single
+    # traversal, into prefix + NEWICK_SUFFIXES[variant] (gzipped if
+    # compress is True). If prefix is "-", trees are written to stdout, one
+    # per line and in the given order of variants.
+    from newick_io import write_newicks, open_output
+    for v in variants:
+        if v not in NEWICK_SUFFIXES:
+            raise ValueError("Unknown newick variant %s" %v)
+    if prefix == "-":
+        # The first variant is streamed, the rest are buffered so they are
+        # not interleaved
+        import cStringIO
+        streams = [sys.stdout] + [cStringIO.StringIO() for v in variants[1:]]
+    else:
+        suffix = ".gz" if compress else ""
+        streams = [open_output(prefix + NEWICK_SUFFIXES[v] + suffix, compress) for v in variants]
+    write_newicks(t, lambda n: n.children, zip(streams, map(_newick_label, variants)))
+    if prefix == "-":
+        for out in streams[1:]:
+            sys.stdout.write(out.getvalue())
+    else:
+        for out in streams:
+            out.close()
+
+def open_input(fname):
+    if fname == "-":
+        return sys.stdin
+    return open(fname, "rU")
+
 def test():
     # TESTS
     get_sp_lineage("9606")
@@ -255,6 +812,16 @@ def test():
 
 
 if __name__ == "__main__":
+    if sys.argv[1:2] == ["serve"]:
+        # Query daemon mode, see ncbi_server.py
+        import ncbi_server
+        ncbi_server.main(sys.argv[2:])
+        sys.exit(0)
+
+    from argparse import ArgumentParser
+    log.basicConfig(level=log.INFO, \
+                        format="%(levelname)s - %(message)s" )
+
     parser = ArgumentParser(description=__DESCRIPTION__)
     # name or flags - Either a name or a list of option strings, e.g. foo or -f, --foo.
     # action - The basic type of action to be taken when this argument is encountered at the command line. (store, store_const, store_true, store_false, append, append_const, version)
@@ -274,7 +841,7 @@ if __name__ == "__main__":
 
     parser.add_argument("-tf", "--taxid_file", dest="taxid_file",   
                         type=str, 
-                        help="""file containing a list of taxids (one per line)""")
+                        help="""file containing a list of taxids (one per line). Use '-' to read from stdin""")
 
     parser.add_argument("-r", "--reftree", dest="reftree",   
                         type=str, 
@@ -286,13 +853,28 @@ if __name__ == "__main__":
 
     parser.add_argument("-nf", "--names_file", dest="names_file",   
                         type=str, 
-                        help="""file containing a list of taxids (one per line)""")
+                        help="""file containing a list of names (one per line). Use '-' to read from stdin""")
 
     parser.add_argument("-x", "--taxonomy", dest="taxonomy",   
                         action="store_true",
                         help=("returns a pruned version of the NCBI taxonomy"
                               " tree containing target species"))
 
+    parser.add_argument("--newick_variants", dest="newick_variants", type=str,
+                        default=','.join(NEWICK_VARIANTS),
+                        help=("Comma separated list of newick files written"
+                              " by --taxonomy, among %s (default: all)"
+                              %', '.join(NEWICK_VARIANTS)))
+
+    parser.add_argument("--newick_prefix", dest="newick_prefix", type=str,
+                        default="your_ncbi_query",
+                        help=("Prefix of the newick files written by"
+                              " --taxonomy. Use '-' to write them to stdout"
+                              " (one tree per line)"))
+
+    parser.add_argument("--gzip", dest="gzip", action="store_true",
+                        help="Writes --taxonomy newick files gzip compressed")
+
     parser.add_argument("--show_tree", dest="show_tree",   
                         action="store_true",
                         help="""shows the NCBI taxonomy tree of the provided species""")
@@ -323,57 +905,82 @@ if __name__ == "__main__":
                               " species names that could not be translated"
                               " into taxids. A float number must be provided"
                               " indicating the minimum string similarity."))
+
+    parser.add_argument("--fuzzy_cache", dest="fuzzy_cache", type=str,
+                        help=("File used to cache --fuzzy results (default:"
+                              " $NCBI_FUZZY_CACHE or"
+                              " ~/.cache/ncbi_taxonomy/fuzzy_cache.sqlite)."
+                              " An empty value disables the cache."))
+
+    parser.add_argument("--stream", dest="stream",   
+                        action="store_true",
+                        help=("Translates names (-nf) or taxids (-tf) in"
+                              " batches, writing results in input order as"
+                              " soon as each batch is resolved. Memory usage"
+                              " does not depend on the input size."))
+
+    parser.add_argument("--batch_size", dest="batch_size", type=int,
+                        default=1000,
+                        help=("Number of lines translated at once in"
+                              " --stream mode"))
+
+    parser.add_argument("--profile", dest="profile",
+                        action="store_true",
+                        help=("Reports function timings, SQL statement counts,"
+                              " slow queries and a cProfile summary (stderr)"))
+
+    parser.add_argument("--profile_json", dest="profile_json", type=str,
+                        help=("Saves the --profile metrics as JSON into the"
+                              " given file"))
    
     
     args = parser.parse_args()
     
+    if args.fuzzy_cache is not None:
+        FUZZY_CACHE_FILE = args.fuzzy_cache
     if args.fuzzy:
         import pysqlite2.dbapi2 as sqlite3
         c = sqlite3.connect(os.path.join(module_path, 'taxa.sqlite'))
+        load_fuzzy_extension()
+
+    if args.profile or args.profile_json:
+        import atexit
+        profiler = profiling.start_profiler()
+        atexit.register(profiling.stop_profiler, profiler, args.profile_json)
+        c = profiling.TracedConnection(c)
+
+    if args.stream:
+        if args.names_file:
+            stream_name_translations(open_input(args.names_file), sys.stdout,
+                                     args.batch_size, args.fuzzy)
+        if args.taxid_file:
+            stream_taxid_translations(open_input(args.taxid_file), sys.stdout,
+                                      args.batch_size)
+        sys.exit(0)
         
     all_names = set([])
     all_taxids = []
 
     if args.names_file:
-        all_names.update(map(strip, open(args.names_file, "rU").read().split("\n")))
+        all_names.update(map(strip, open_input(args.names_file).read().split("\n")))
     if args.names:
         all_names.update(map(strip, " ".join(args.names).split(",")))
     all_names.discard("")
     #all_names = set([n.lower() for n in all_names])
-    not_found = set()
-    name2realname = {}
-    name2score = {}
     if all_names:
         log.info("Dumping name translations:")
-        name2id = get_name_translator(all_names)
-        not_found = all_names - set(name2id.keys())
-
-        if args.fuzzy and not_found:
-            log.info("%s unknown names", len(not_found))
-            for name in not_found:
-                # enable extension loading
-                c.enable_load_extension(True)
-                c.execute("select load_extension('%s')" % os.path.join(module_path,
-                                            "SQLite-Levenshtein/levenshtein.sqlext"))
-                tax, realname, sim = get_fuzzy_name_translation(name, args.fuzzy)
-                if tax:
-                    name2id[name] = tax
-                    name2realname[name] = realname
-                    name2score[name] = "Fuzzy:%0.2f" %sim
-                    
+        name2row = name_translation_rows(all_names, args.fuzzy)
         for name in all_names:
-            taxid = name2id.get(name, "???")
-            realname = name2realname.get(name, name)
-            score = name2score.get(name, "Exact:1.0")
-            print "\t".join(map(str, [score, name, realname.capitalize(), taxid]))
+            print "\t".join(map(str, name2row[name]))
             
     if args.taxid_file:
-        all_taxids.extend(map(strip, open(args.taxid_file, "rU").read().split("\n")))
+        all_taxids.extend(map(strip, open_input(args.taxid_file).read().split("\n")))
     if args.taxid:
         all_taxids.extend(args.taxid)
         
     reftree = None
     if args.reftree:
+        from ete2 import PhyloTree
         reftree = PhyloTree(args.reftree)
         all_taxids.extend(list(set([n.name for n in reftree.iter_leaves()])))
                 
@@ -381,13 +988,10 @@ if __name__ == "__main__":
         log.info("Dumping %d taxid translations:" %len(all_taxids))
         all_taxids = set(all_taxids)
         all_taxids.discard("")
-        translator = get_taxid_translator(all_taxids)
-        for taxid, name in translator.iteritems():
-            lineage = get_sp_lineage(taxid)
-            named_lineage = ','.join(translate_to_names(lineage))
-            lineage = ','.join(map(str, lineage))
-            print "\t".join(map(str, [taxid, name, named_lineage, lineage ]))
-        for notfound in all_taxids - set(str(k) for k in translator.iterkeys()):
+        id2row = taxid_info_rows(all_taxids)
+        for row in id2row.itervalues():
+            print "\t".join(map(str, row))
+        for notfound in set(map(str, all_taxids)) - set(str(k) for k in id2row.iterkeys()):
             print >>sys.stderr, notfound, "NOT FOUND"
             
     if all_taxids and args.taxonomy:
@@ -404,34 +1008,15 @@ if __name__ == "__main__":
             n.name = "%s{%s}" %(id2name.get(int(n.name), n.name), n.name)
 
         if args.collapse_subspecies:
-            species_nodes = [n for n in t.traverse() if n.rank == "species"
-                             if int(n.taxid) in all_taxids]
-            for sp_node in species_nodes:
-                bellow = sp_node.get_descendants()
-                if bellow:
-                    # creates a copy of the species node
-                    connector = sp_node.__class__()
-                    for f in sp_node.features:
-                        connector.add_feature(f, getattr(sp_node, f))
-                    connector.name = connector.name + "{species}"
-                    for n in bellow:
-                        n.detach()
-                        n.name = n.name + "{%s}" %n.rank
-                        sp_node.add_child(n)
-                    sp_node.add_child(connector)
-                    sp_node.add_feature("collapse_subspecies", "1")
+            collapse_subspecies(t, all_taxids)
                 
         if args.show_tree:
             t.show()
             
-        print "\n\n  ===== Newick files saved as 'your_taxa_query.*' ===== "
-        t.write(format=9, outfile="your_ncbi_query.nw")
-        t.write(format=8, outfile="your_ncbi_query.named.nw")
-        t.write(format=9, features=["taxid", "name", "rank", "bgcolor", "sci_name", "collapse_subspecies"],
-                outfile="your_ncbi_query.extended.nw")
-        for i in t.iter_leaves():
-            i.name = i.taxid
-        t.write(format=9, outfile="your_ncbi_query.taxids.nw")
+        variants = [v.strip() for v in args.newick_variants.split(",") if v.strip()]
+        if args.newick_prefix != "-":
+            print "\n\n  ===== Newick files saved as '%s.*' ===== " %args.newick_prefix
+        write_taxonomy_newicks(t, variants, args.newick_prefix, args.gzip)
 
     if all_taxids and reftree:
         translator = get_taxid_translator(all_taxids)
@@ -0,0 +1,283 @@
+#!/usr/bin/env python
+# Query daemon for ncbi_query. Keeps the taxonomy DB open (and its caches
+# warm) and answers requests sent by ncbi_client.QueryClient, so callers do
+# not pay the python startup, imports and DB opening on every query.
+#
+# Protocol: one JSON object per line, {"method": ..., "args": [...],
+# "kwargs": {...}}, answered by one JSON line, {"result": ...} or
+# {"error": ...}.
+import sys
+import os
+import json
+import time
+import socket
+import threading
+import Queue
+import SocketServer
+from collections import deque
+from itertools import chain
+from argparse import ArgumentParser
+import logging as log
+
+import ncbi_query as ncbi
+from ncbi_client import DEFAULT_ADDRESS, parse_address
+
+__DESCRIPTION__ = """
+Serves ncbi_query requests over a local Unix socket or TCP port
+"""
+
+def _topology(taxids, intermediate_nodes=False, rank_limit=None):
+    # Topologies are returned as extended newick, with taxids as node names
+    t = ncbi.get_topology(set(taxids), intermediate_nodes, rank_limit)
+    return t.write(format=8, features=["rank"], format_root_node=True)
+
+METHODS = {
+    "ping": lambda: "pong",
+    "get_name_translator": lambda names: ncbi.get_name_translator(set(names)),
+    "get_taxid_translator": ncbi.get_taxid_translator,
+    "get_lineage_translator": ncbi.get_lineage_translator,
+    "get_sp_lineage": ncbi.get_sp_lineage,
+    "get_ranks": ncbi.get_ranks,
+    "translate_to_names": ncbi.translate_to_names,
+    "get_topology": _topology,
+    "get_fuzzy_name_translation": ncbi.get_fuzzy_name_translation,
+    "get_fuzzy_name_candidates": ncbi.get_fuzzy_name_candidates,
+    "complete_name": ncbi.complete_name,
+    "name_translation_rows": lambda names, fuzzy=None: ncbi.name_translation_rows(set(names), fuzzy),
+    "taxid_info_rows": ncbi.taxid_info_rows,
+    }
+
+# A single DB connection is shared by all client threads
+_db_lock = threading.Lock()
+
+class Coalescer(object):
+    # Merges concurrent calls to a batchable method into a single set query.
+    # Calls are queued and a worker thread takes all those arriving within
+    # `window` seconds after the first one (up to `batch_size` calls), runs
+    # batch_fn() over the list of their arguments and hands each caller its
+    # own part of the result, as returned by split_fn(arg, batch_result).
+    # Arguments are first converted by check_fn(arg) in the calling thread,
+    # so invalid ones fail their own request only, not the whole batch.
+    def __init__(self, batch_fn, split_fn, window=0.002, batch_size=500,
+                 check_fn=None):
+        self.batch_fn = batch_fn
+        self.split_fn = split_fn
+        self.check_fn = check_fn
+        self.window = window
+        self.batch_size = batch_size
+        self.queue = Queue.Queue()
+        self.requests = 0
+        self.batches = 0
+        self.waits = deque(maxlen=10000)
+        worker = threading.Thread(target=self._run)
+        worker.daemon = True
+        worker.start()
+
+    def __call__(self, arg):
+        if self.check_fn:
+            arg = self.check_fn(arg)
+        # [done, result, error, enqueue time]
+        slot = [threading.Event(), None, None, time.time()]
+        self.queue.put((arg, slot))
+        slot[0].wait()
+        if slot[2] is not None:
+            raise slot[2]
+        return slot[1]
+
+    def _run(self):
+        while True:
+            batch = [self.queue.get()]
+            deadline = time.time() + self.window
+            while len(batch) < self.batch_size:
+                timeout = deadline - time.time()
+                try:
+                    if timeout > 0:
+                        batch.append(self.queue.get(timeout=timeout))
+                    else:
+                        batch.append(self.queue.get_nowait())
+                except Queue.Empty:
+                    break
+            start = time.time()
+            self.requests += len(batch)
+            self.batches += 1
+            for arg, slot in batch:
+                self.waits.append(start - slot[3])
+            try:
+                with _db_lock:
+                    result = self.batch_fn([arg for arg, slot in batch])
+            except Exception, e:
+                for arg, slot in batch:
+                    slot[2] = e
+                    slot[0].set()
+                continue
+            for arg, slot in batch:
+                try:
+                    slot[1] = self.split_fn(arg, result)
+                except Exception, e:
+                    slot[2] = e
+                slot[0].set()
+
+    def stats(self):
+        waits = sorted(self.waits)
+        def percentile(p):
+            if not waits:
+                return 0.0
+            return waits[min(len(waits)-1, int(len(waits) * p))] * 1000
+        return {"requests": self.requests,
+                "batches": self.batches,
+                "avg_batch_size": float(self.requests) / self.batches if self.batches else 0.0,
+                "queue_wait_ms": {"avg": sum(waits) * 1000 / len(waits) if waits else 0.0,
+                                  "p50": percentile(0.50),
+                                  "p95": percentile(0.95),
+                                  "max": waits[-1] * 1000 if waits else 0.0}}
+
+def _check_taxids(taxids):
+    # Taxids that are not integers are skipped, as unknown taxids are by
+    # get_taxid_translator()
+    valid = []
+    for tax in taxids:
+        try:
+            valid.append(int(tax))
+        except (TypeError, ValueError):
+            log.info("Invalid taxid %r skipped", tax)
+    return valid
+
+def _check_taxid(taxid):
+    if not taxid:
+        return None
+    try:
+        return int(taxid)
+    except (TypeError, ValueError):
+        raise ValueError("Invalid taxid %r" %(taxid,))
+
+def _check_names(names):
+    names = list(names)
+    for name in names:
+        if not isinstance(name, basestring):
+            raise ValueError("Invalid name %r" %(name,))
+    return names
+
+def _split_taxid_translator(taxids, id2name):
+    return dict([(tax, id2name[tax]) for tax in taxids if tax in id2name])
+
+def _split_sp_lineage(taxid, id2lineage):
+    if taxid is None:
+        return None
+    return id2lineage.get(taxid, [1])
+
+def _split_name_translator(names, name2id):
+    # Only one spelling of the same name is kept by get_name_translator
+    lower2id = dict([(name.lower(), taxid) for name, taxid in name2id.iteritems()])
+    name2taxid = {}
+    for name in names:
+        taxid = name2id.get(name, lower2id.get(name.lower()))
+        if taxid is not None:
+            name2taxid[name] = taxid
+    return name2taxid
+
+COALESCED = {}
+
+def enable_coalescing(window, batch_size):
+    COALESCED["get_taxid_translator"] = Coalescer(
+        lambda args: ncbi.get_taxid_translator(set(chain(*args))),
+        _split_taxid_translator, window, batch_size, _check_taxids)
+    COALESCED["get_sp_lineage"] = Coalescer(
+        lambda args: ncbi.get_lineage_translator([tax for tax in args if tax is not None]),
+        _split_sp_lineage, window, batch_size, _check_taxid)
+    COALESCED["get_name_translator"] = Coalescer(
+        lambda args: ncbi.get_name_translator(set(chain(*args))),
+        _split_name_translator, window, batch_size, _check_names)
+
+def get_stats():
+    return dict([(method, coalescer.stats()) for method, coalescer in COALESCED.iteritems()])
+
+def dispatch(method, args, kargs):
+    if method in COALESCED and not kargs:
+        return COALESCED[method](*args)
+    if method == "stats":
+        return get_stats()
+    if method not in METHODS:
+        raise ValueError("Unknown method %s" %method)
+    with _db_lock:
+        return METHODS[method](*args, **kargs)
+
+class QueryHandler(SocketServer.StreamRequestHandler):
+    def handle(self):
+        for line in iter(self.rfile.readline, ""):
+            try:
+                request = json.loads(line)
+                result = dispatch(request["method"], request.get("args", []),
+                                  request.get("kwargs", {}))
+                response = {"result": result}
+            except Exception, e:
+                log.exception("Error processing request")
+                response = {"error": "%s: %s" %(e.__class__.__name__, e)}
+            self.wfile.write(json.dumps(response) + "\n")
+            self.wfile.flush()
+
+class UnixQueryServer(SocketServer.ThreadingMixIn, SocketServer.UnixStreamServer):
+    daemon_threads = True
+
+class TCPQueryServer(SocketServer.ThreadingMixIn, SocketServer.TCPServer):
+    daemon_threads = True
+    allow_reuse_address = True
+
+def open_db(fuzzy=False, cache_mb=256):
+    # Replaces the ncbi_query connection by one that can be used from the
+    # handler threads
+    if fuzzy:
+        import pysqlite2.dbapi2 as sqlite3
+        ncbi.sqlite3 = sqlite3
+    ncbi.c = ncbi.sqlite3.connect(os.path.join(ncbi.module_path, 'taxa.sqlite'),
+                                  check_same_thread=False)
+    ncbi.c.execute("PRAGMA cache_size=%d;" %(-1024 * cache_mb))
+    if fuzzy:
+        ncbi.load_fuzzy_extension()
+
+def serve(address=DEFAULT_ADDRESS):
+    family, addr = parse_address(address)
+    if family == socket.AF_UNIX:
+        if os.path.exists(addr):
+            os.remove(addr)
+        server = UnixQueryServer(addr, QueryHandler)
+    else:
+        server = TCPQueryServer(addr, QueryHandler)
+    log.info("Serving ncbi_query requests at %s", address)
+    try:
+        server.serve_forever()
+    finally:
+        server.server_close()
+        if family == socket.AF_UNIX and os.path.exists(addr):
+            os.remove(addr)
+
+def main(argv):
+    parser = ArgumentParser(description=__DESCRIPTION__)
+    parser.add_argument("--address", dest="address", type=str,
+                        default=DEFAULT_ADDRESS,
+                        help=("Unix socket path or host:port to listen on"
+                              " (default: %s)" %DEFAULT_ADDRESS))
+    parser.add_argument("--fuzzy", dest="fuzzy", action="store_true",
+                        help=("Enables fuzzy searches (requires pysqlite2 and"
+                              " the levenshtein extension)"))
+    parser.add_argument("--batch_window_ms", dest="batch_window_ms", type=float,
+                        default=2.0,
+                        help=("Concurrent taxid, lineage and name translation"
+                              " requests arriving within this time window are"
+                              " resolved together. Use a negative value to"
+                              " disable request coalescing."))
+    parser.add_argument("--batch_size", dest="batch_size", type=int, default=500,
+                        help="Maximum number of requests coalesced into one query")
+    parser.add_argument("--cache_mb", dest="cache_mb", type=int, default=256,
+                        help="SQLite page cache size, in megabytes")
+    args = parser.parse_args(argv)
+    log.basicConfig(level=log.INFO, format="%(levelname)s - %(message)s")
+    open_db(args.fuzzy, args.cache_mb)
+    if args.batch_window_ms >= 0:
+        enable_coalescing(args.batch_window_ms / 1000.0, args.batch_size)
+    try:
+        serve(args.address)
+    except KeyboardInterrupt:
+        pass
+
+if __name__ == "__main__":
+    main(sys.argv[1:])
@@ -0,0 +1,78 @@
+# Iterative newick writer producing several variants of the same tree in a
+# single traversal. Trees are not required to be ete2 instances: nodes are
+# only accessed through the children() and label functions, so the same
+# code serves ete2 trees and plain parent/children tables. Output uses the
+# same conventions as ete2 (illegal characters in names and NHX values are
+# replaced by "_"), so files can be read back with ete2.
+import re
+import gzip
+
+_ILLEGAL_NEWICK_CHARS = re.compile(r"[:;(),\[\]\t\n\r=]")
+
+# Number of pending chunks before they are written into the outputs
+FLUSH_SIZE = 10000
+
+def safe_label(value):
+    return _ILLEGAL_NEWICK_CHARS.sub("_", str(value))
+
+def nhx(pairs):
+    # NHX comment for a list of (feature, value) pairs
+    if not pairs:
+        return ""
+    return "[&&NHX:%s]" %':'.join(["%s=%s" %(key, safe_label(value)) for key, value in pairs])
+
+def open_output(fname, compress=False):
+    if compress:
+        return gzip.open(fname, "wb")
+    return open(fname, "w")
+
+def write_newicks(root, children, outputs, format_root_node=False):
+    # Writes the tree under root into all outputs at once. `outputs` is a
+    # list of (stream, label) pairs, where label(node, is_leaf) returns the
+    # text written after the node (name, NHX data, etc.). children(node)
+    # returns the list of children of a node. Tree depth is not limited by
+    # the recursion limit.
+    buffers = [[] for out in outputs]
+    labels = [label for out, label in outputs]
+
+    def flush():
+        for (out, label), buf in zip(outputs, buffers):
+            out.write(''.join(buf))
+            del buf[:]
+
+    # (node, closing) entries; None stands for a sibling separator
+    stack = [(root, False)]
+    pending = 0
+    while stack:
+        node, closing = stack.pop()
+        if node is None:
+            for buf in buffers:
+                buf.append(",")
+        elif closing:
+            if node is root and not format_root_node:
+                for buf in buffers:
+                    buf.append(")")
+            else:
+                for label, buf in zip(labels, buffers):
+                    buf.append(")")
+                    buf.append(label(node, False))
+        else:
+            kids = children(node)
+            if kids:
+                for buf in buffers:
+                    buf.append("(")
+                stack.append((node, True))
+                for i in xrange(len(kids) - 1, -1, -1):
+                    stack.append((kids[i], False))
+                    if i:
+                        stack.append((None, False))
+            else:
+                for label, buf in zip(labels, buffers):
+                    buf.append(label(node, True))
+        pending += 1
+        if pending >= FLUSH_SIZE:
+            flush()
+            pending = 0
+    for buf in buffers:
+        buf.append(";\n")
+    flush()
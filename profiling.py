@@ -0,0 +1,216 @@
+# Lightweight instrumentation for ncbi_query, ncbi_consensus and
+# update_taxadb: per-function timers, SQL statement counters with a slow
+# query log, named phase timings and an optional cProfile report. Function
+# timers and SQL tracing only record anything after enable() is called, so
+# they cost a flag check otherwise. All metrics can be exported as JSON.
+import sys
+import time
+import logging as log
+from functools import wraps
+from contextlib import contextmanager
+
+ENABLED = False
+# Statements taking longer than this are logged and kept in the report
+SLOW_QUERY_MS = 100.0
+MAX_SLOW_QUERIES = 100
+
+# function name -> [calls, total seconds, max seconds]
+_timers = {}
+# (phase name, seconds), in execution order
+_phases = []
+_sql = {"statements": 0, "total_s": 0.0}
+_slow_queries = []
+
+def enable(slow_query_ms=None):
+    global ENABLED, SLOW_QUERY_MS
+    ENABLED = True
+    if slow_query_ms is not None:
+        SLOW_QUERY_MS = slow_query_ms
+
+def reset():
+    _timers.clear()
+    del _phases[:]
+    del _slow_queries[:]
+    _sql["statements"] = 0
+    _sql["total_s"] = 0.0
+
+def _record(name, elapsed):
+    timer = _timers.get(name)
+    if timer is None:
+        _timers[name] = [1, elapsed, elapsed]
+    else:
+        timer[0] += 1
+        timer[1] += elapsed
+        if elapsed > timer[2]:
+            timer[2] = elapsed
+
+def timed_call(name, fn, *args, **kargs):
+    # Calls fn, recording its time under the given timer name
+    t1 = time.time()
+    try:
+        return fn(*args, **kargs)
+    finally:
+        _record(name, time.time() - t1)
+
+def timed(fn):
+    # Decorator timing every call to fn while instrumentation is enabled
+    name = fn.__name__
+    @wraps(fn)
+    def wrapper(*args, **kargs):
+        if not ENABLED:
+            return fn(*args, **kargs)
+        return timed_call(name, fn, *args, **kargs)
+    return wrapper
+
+@contextmanager
+def phase(name):
+    # Phases are always recorded, as they are meant for coarse steps
+    t1 = time.time()
+    try:
+        yield
+    finally:
+        _phases.append((name, time.time() - t1))
+
+class _TracedCursor(object):
+    # Time spent fetching rows is added to the statement that produced them
+    def __init__(self, cursor, sql, elapsed):
+        self._cursor = cursor
+        self._sql = sql
+        self._elapsed = elapsed
+        self._logged = False
+        self._check_slow()
+
+    def _check_slow(self):
+        if not self._logged and self._elapsed * 1000 > SLOW_QUERY_MS:
+            self._logged = True
+            log.warning("Slow query (%0.1f ms): %s", self._elapsed * 1000, self._sql[:200])
+            if len(_slow_queries) < MAX_SLOW_QUERIES:
+                _slow_queries.append(self)
+
+    def _timed(self, fn, *args):
+        t1 = time.time()
+        try:
+            return fn(*args)
+        finally:
+            elapsed = time.time() - t1
+            self._elapsed += elapsed
+            _sql["total_s"] += elapsed
+            self._check_slow()
+
+    def fetchone(self):
+        return self._timed(self._cursor.fetchone)
+
+    def fetchmany(self, *args):
+        return self._timed(self._cursor.fetchmany, *args)
+
+    def fetchall(self):
+        return self._timed(self._cursor.fetchall)
+
+    def __iter__(self):
+        while True:
+            row = self._timed(self._cursor.fetchone)
+            if row is None:
+                return
+            yield row
+
+    def __getattr__(self, attr):
+        return getattr(self._cursor, attr)
+
+class TracedConnection(object):
+    # Counts and times the statements run through a sqlite3 connection. The
+    # sqlite3 module shipped with python 2 has no set_trace_callback(), so
+    # the connection is proxied instead.
+    def __init__(self, conn):
+        self._conn = conn
+
+    def _run(self, method, sql, *args):
+        if not ENABLED:
+            return method(sql, *args)
+        t1 = time.time()
+        cursor = method(sql, *args)
+        elapsed = time.time() - t1
+        _sql["statements"] += 1
+        _sql["total_s"] += elapsed
+        return _TracedCursor(cursor, sql, elapsed)
+
+    def execute(self, sql, *args):
+        return self._run(self._conn.execute, sql, *args)
+
+    def executemany(self, sql, *args):
+        return self._run(self._conn.executemany, sql, *args)
+
+    def __getattr__(self, attr):
+        return getattr(self._conn, attr)
+
+def peak_rss_mb():
+    import resource
+    # ru_maxrss is in KB on Linux
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024.0
+
+def metrics():
+    functions = {}
+    for name, (calls, total, longest) in _timers.iteritems():
+        functions[name] = {"calls": calls,
+                           "total_ms": total * 1000,
+                           "avg_ms": total * 1000 / calls,
+                           "max_ms": longest * 1000}
+    return {"functions": functions,
+            "phases": [{"phase": name, "ms": elapsed * 1000} for name, elapsed in _phases],
+            "sql": {"statements": _sql["statements"],
+                    "total_ms": _sql["total_s"] * 1000,
+                    "slow_queries": [{"sql": q._sql, "ms": q._elapsed * 1000}
+                                     for q in _slow_queries]},
+            "peak_rss_mb": peak_rss_mb()}
+
+def report(out=sys.stderr):
+    data = metrics()
+    if data["phases"]:
+        print >>out, "Phase timings (ms):"
+        for entry in data["phases"]:
+            print >>out, "  %-30s %10.1f" %(entry["phase"], entry["ms"])
+    if data["functions"]:
+        print >>out, "Function timers:"
+        print >>out, "  %-30s %8s %12s %10s %10s" %("function", "calls", "total ms", "avg ms", "max ms")
+        for name, f in sorted(data["functions"].iteritems(), key=lambda x: -x[1]["total_ms"]):
+            print >>out, "  %-30s %8d %12.1f %10.3f %10.1f" %(name, f["calls"], f["total_ms"],
+                                                            f["avg_ms"], f["max_ms"])
+    sql = data["sql"]
+    if ENABLED:
+        print >>out, "SQL statements: %d (%0.1f ms), %d slower than %s ms" %(
+            sql["statements"], sql["total_ms"], len(sql["slow_queries"]), SLOW_QUERY_MS)
+    print >>out, "Peak RSS: %0.1f MB" %data["peak_rss_mb"]
+
+def dump_json(fname, extra=None):
+    import json
+    data = metrics()
+    if extra:
+        data.update(extra)
+    json.dump(data, open(fname, "w"), indent=2, sort_keys=True)
+
+def start_profiler(slow_query_ms=None):
+    # Enables instrumentation and cProfile. Returns the profiler to be
+    # passed to stop_profiler().
+    import cProfile
+    enable(slow_query_ms)
+    profiler = cProfile.Profile()
+    profiler.enable()
+    return profiler
+
+def stop_profiler(profiler, json_file=None, out=sys.stderr, top=25):
+    # Prints the cProfile summary (top functions by cumulative time) and the
+    # collected metrics, and optionally saves both as JSON.
+    import pstats
+    profiler.disable()
+    stats = pstats.Stats(profiler, stream=out)
+    stats.sort_stats("cumulative").print_stats(top)
+    report(out)
+    if json_file:
+        entries = []
+        for (fname, line, func), (cc, ncalls, tottime, cumtime, callers) in stats.stats.iteritems():
+            entries.append({"function": "%s:%s(%s)" %(fname, line, func),
+                            "calls": ncalls,
+                            "total_ms": tottime * 1000,
+                            "cumulative_ms": cumtime * 1000})
+        entries.sort(key=lambda e: -e["cumulative_ms"])
+        dump_json(json_file, {"profile": entries[:top]})
+        print >>out, "Metrics saved into", json_file
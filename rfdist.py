@@ -0,0 +1,155 @@
+# Robinson-Foulds distances against a fixed reference tree. The reference
+# is indexed once (preorder numbering of its nodes and an LCA table, see
+# LCAIndex), so comparing a tree only costs O(n log n) on the size of that
+# tree, instead of recomputing all the reference bipartitions as
+# robinson_foulds() does.
+#
+# Clusters are encoded as bitsets (python ints) over the leaves shared by
+# both trees, numbered in reference preorder. Restricted to those leaves,
+# the reference clusters are the single leaves plus the clusters of the
+# LCAs of consecutive leaves, and each of them is a contiguous range of
+# bits. Results are the same as those of ete's rooted robinson_foulds().
+from bisect import bisect_left
+
+from ete_dev.coretype.tree import TreeError
+
+def _children(node):
+    return node.children
+
+class LCAIndex(object):
+    # Preorder numbering of the nodes of a tree and a sparse table over its
+    # Euler tour, answering LCA queries in constant time. Ancestors have
+    # lower preorder ids than their descendants, so the LCA of two nodes is
+    # the minimum id found between their first occurrences in the tour.
+    def __init__(self, tree):
+        self.tree = tree
+        # preorder id -> node
+        self.nodes = []
+        # preorder id -> preorder id past the last node of its subtree
+        self.end = []
+        euler = []
+        first = []
+        stack = [(tree, None)]
+        while stack:
+            node, node_id = stack.pop()
+            if node_id is not None:
+                # back from a child. The last one sets the actual end.
+                self.end[node_id] = len(self.end)
+                euler.append(node_id)
+                continue
+            node_id = len(self.nodes)
+            self.nodes.append(node)
+            self.end.append(node_id + 1)
+            first.append(len(euler))
+            euler.append(node_id)
+            for ch in reversed(node.children):
+                stack.append((node, node_id))
+                stack.append((ch, None))
+        self.first = first
+        self.table = [euler]
+        span = 1
+        while span * 2 <= len(euler):
+            prev = self.table[-1]
+            self.table.append(map(min, prev[:len(prev) - span], prev[span:]))
+            span *= 2
+        self._node2id = None
+
+    def lca(self, a, b):
+        # LCA of two nodes given by preorder id
+        i, j = self.first[a], self.first[b]
+        if i > j:
+            i, j = j, i
+        level = (j - i + 1).bit_length() - 1
+        row = self.table[level]
+        return min(row[i], row[j - (1 << level) + 1])
+
+    def get_common_ancestor(self, nodes):
+        # Same as tree.get_common_ancestor(nodes) for a list of nodes
+        if self._node2id is None:
+            self._node2id = dict([(node, i) for i, node in enumerate(self.nodes)])
+        node2id = self._node2id
+        common = None
+        for node in nodes:
+            node_id = node2id[node]
+            common = node_id if common is None else self.lca(common, node_id)
+        return self.nodes[common]
+
+class RFReference(LCAIndex):
+    def __init__(self, tree, attr="name"):
+        LCAIndex.__init__(self, tree)
+        self.attr = attr
+        self.rooted = len(tree.children) == 2
+        # leaf attribute -> preorder id
+        self.attr2leaf = {}
+        # number of leaves of duplicated attributes
+        self.attr2count = {}
+        self.has_duplicates = False
+        for node_id, node in enumerate(self.nodes):
+            if not node.children and hasattr(node, attr):
+                value = getattr(node, attr)
+                if value in self.attr2leaf:
+                    self.has_duplicates = True
+                    self.attr2count[value] = self.attr2count.get(value, 1) + 1
+                else:
+                    self.attr2leaf[value] = node_id
+
+    def robinson_foulds(self, t, attr_t1="name", children=None):
+        # Same as t.robinson_foulds(reference_tree, attr_t1, attr_t2=attr).
+        # Returns [rf, max_rf, common_attrs, edges_t1, edges_ref, set(),
+        # set()], where edges are bitsets. t does not need to be an ete
+        # tree if children(node), returning the list of children of a
+        # node, is given.
+        if children is None:
+            children = _children
+        if not self.rooted or len(children(t)) != 2:
+            raise TreeError("Unrooted tree found! You may want to activate the unrooted_trees flag.")
+        # nodes of t, children before parents, and their number of children
+        nodes = []
+        stack = [t]
+        while stack:
+            node = stack.pop()
+            kids = children(node)
+            nodes.append((node, len(kids)))
+            stack.extend(kids)
+        nodes.reverse()
+
+        values = [getattr(n, attr_t1) for n, nkids in nodes
+                  if not nkids and hasattr(n, attr_t1)]
+        attr2leaf = self.attr2leaf
+        common = set([v for v in values if v in attr2leaf])
+        if len([True for v in values if v in common]) > len(common):
+            raise TreeError('Duplicated items found in source tree')
+        if self.has_duplicates:
+            if sum([self.attr2count.get(v, 1) for v in common]) > len(common):
+                raise TreeError('Duplicated items found in reference tree')
+
+        leaves = sorted([attr2leaf[v] for v in common])
+        leaf2bit = dict([(leaf, 1 << i) for i, leaf in enumerate(leaves)])
+        attr2bit = dict([(v, leaf2bit[attr2leaf[v]]) for v in common])
+
+        edges_ref = set(leaf2bit.itervalues())
+        for i in xrange(len(leaves) - 1):
+            node = self.lca(leaves[i], leaves[i+1])
+            lo = bisect_left(leaves, node)
+            hi = bisect_left(leaves, self.end[node])
+            edges_ref.add((1 << hi) - (1 << lo))
+
+        edges_t1 = set()
+        # bitsets of the pending subtrees
+        pending = []
+        for node, nkids in nodes:
+            bits = 0
+            if nkids:
+                for i in xrange(nkids):
+                    bits |= pending.pop()
+            elif hasattr(node, attr_t1):
+                bits = attr2bit.get(getattr(node, attr_t1), 0)
+            pending.append(bits)
+            if bits:
+                edges_t1.add(bits)
+
+        rf = len(edges_t1 ^ edges_ref)
+        # bitsets with more than one leaf, excluding the two root clusters
+        max_parts = (len([b for b in edges_t1 if b & (b - 1)]) +
+                     len([b for b in edges_ref if b & (b - 1)])) - 2
+        return [rf, max_parts, common, edges_t1, edges_ref, set(), set()]
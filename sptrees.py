@@ -0,0 +1,151 @@
+# Bounded enumeration of the species trees contained in a gene tree with
+# duplications (TreeKO, as in ete's get_speciation_trees()), and streaming
+# statistics to average values over them.
+#
+# The number of species trees under each node is computed first (the sum
+# over the children of duplication nodes, the product of the two children
+# of speciation nodes). The k-th species tree can then be decoded directly
+# from those counts, so trees are produced one by one, in the same order
+# as get_speciation_trees(), and any subset of them (the first N or a
+# random sample) is obtained without going through the others. Species
+# trees are nested (left, right) tuples of the original leaf nodes.
+import random
+
+import numpy
+
+# Values kept to compute the median in RunningStats. The median is exact
+# up to this number of values, and estimated from a uniform sample of
+# them otherwise.
+MEDIAN_SAMPLE_SIZE = 10000
+
+def sptree_children(node):
+    # children() function of the species trees, see rfdist
+    if type(node) is tuple:
+        return node
+    return ()
+
+def is_dup(node):
+    return getattr(node, "evoltype", None) == "D"
+
+def mark_duplications(t, target_attr="species"):
+    # Species overlap algorithm, as used by get_speciation_trees()
+    n2species = t.get_cached_content(store_attr=target_attr)
+    for node, species in n2species.iteritems():
+        sp_subtotal = sum([len(n2species[ch]) for ch in node.children])
+        if len(species) > 1 and len(species) != sp_subtotal:
+            node.add_features(evoltype="D")
+
+def count_speciation_trees(t):
+    # Returns node -> number of species trees under it, and the number of
+    # duplication nodes
+    counts = {}
+    ndups = 0
+    for node in t.traverse("postorder"):
+        if not node.children:
+            counts[node] = 1
+        elif is_dup(node):
+            ndups += 1
+            counts[node] = sum([counts[ch] for ch in node.children])
+        else:
+            counts[node] = counts[node.children[0]] * counts[node.children[1]]
+    return counts, ndups
+
+def get_speciation_tree(t, index, counts):
+    # Decodes the index-th species tree under t. Returns the tree and its
+    # list of leaves.
+    leaves = []
+    values = []
+    # (node, index); node None joins the last two values
+    stack = [(t, index)]
+    while stack:
+        node, index = stack.pop()
+        if node is None:
+            right = values.pop()
+            values.append((values.pop(), right))
+            continue
+        while is_dup(node):
+            for ch in node.children:
+                if index < counts[ch]:
+                    node = ch
+                    break
+                index -= counts[ch]
+        if not node.children:
+            leaves.append(node)
+            values.append(node)
+            continue
+        left, right = node.children[0], node.children[1]
+        stack.append((None, None))
+        stack.append((right, index % counts[right]))
+        stack.append((left, index // counts[right]))
+    return values[0], leaves
+
+def iter_speciation_trees(t, max_trees=0, seed=None, autodetect_duplications=True):
+    # Returns the total number of species trees, the number of duplications
+    # and an iterator over (species tree, leaves). If max_trees is set, the
+    # iterator stops after max_trees trees: the first ones, or a random
+    # sample (in enumeration order) if a seed is given.
+    if autodetect_duplications:
+        mark_duplications(t)
+    counts, ndups = count_speciation_trees(t)
+    ntrees = counts[t]
+    if not max_trees or ntrees <= max_trees:
+        indexes = _iter_range(ntrees)
+    elif seed is None:
+        indexes = _iter_range(max_trees)
+    else:
+        rnd = random.Random(seed)
+        selected = set()
+        while len(selected) < max_trees:
+            selected.add(rnd.randrange(ntrees))
+        indexes = sorted(selected)
+    trees = (get_speciation_tree(t, index, counts) for index in indexes)
+    return ntrees, ndups, trees
+
+def _iter_range(size):
+    # xrange() does not accept long integers
+    index = 0
+    while index < size:
+        yield index
+        index += 1
+
+class RunningStats(object):
+    # Count, sum (compensated), mean and standard deviation (Welford) of a
+    # stream of values, and their median (from a reservoir sample beyond
+    # sample_size values). Memory does not depend on the number of values.
+    def __init__(self, sample_size=MEDIAN_SAMPLE_SIZE, seed=0):
+        self.count = 0
+        self.total = 0.0
+        self._error = 0.0
+        self.mean = 0.0
+        self._m2 = 0.0
+        self.sample_size = sample_size
+        self.sample = []
+        self._rnd = random.Random(seed)
+
+    def add(self, value):
+        self.count += 1
+        # Kahan summation, as precise as numpy.sum() on long streams
+        corrected = value - self._error
+        total = self.total + corrected
+        self._error = (total - self.total) - corrected
+        self.total = total
+        delta = value - self.mean
+        self.mean += delta / self.count
+        self._m2 += delta * (value - self.mean)
+        if len(self.sample) < self.sample_size:
+            self.sample.append(value)
+        else:
+            pos = self._rnd.randrange(self.count)
+            if pos < self.sample_size:
+                self.sample[pos] = value
+
+    def std(self):
+        # population standard deviation, as numpy.std()
+        if not self.count:
+            return numpy.nan
+        return numpy.sqrt(self._m2 / self.count)
+
+    def median(self):
+        if not self.count:
+            return numpy.nan
+        return numpy.median(self.sample)
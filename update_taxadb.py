@@ -1,6 +1,15 @@
 import os
+import sys
+import time
 from string import strip
+from collections import defaultdict
+from argparse import ArgumentParser
 from ete2 import Tree
+import profiling
+from profiling import phase
+from newick_io import write_newicks, nhx, open_output
+from name_keys import (name_length, genus_token, qgram_signature, normalize_name,
+                       prefix_key, PREFIX_SCAN_SIZE, PREFIX_TOP_SIZE)
 
 def load_ncbi_tree_from_dump():
     # Download: ftp://ftp.ncbi.nih.gov/pub/taxonomy/taxdump.tar.gz
@@ -9,43 +18,72 @@ def load_ncbi_tree_from_dump():
     node2taxname = {}
     synonyms = set()
     name2rank = {}
-    print "Loading node names..."
-    for line in open("names.dmp"):
-        fields =  map(strip, line.split("|"))
-        nodename = fields[0]
-        name_type = fields[3].lower()
-        taxname = fields[1]
-        if name_type == "scientific name":
-            node2taxname[nodename] = taxname
-        elif name_type in set(["synonym", "equivalent name", "genbank equivalent name",
-                               "anamorph", "genbank synonym", "genbank anamorph", "teleomorph"]):
-            synonyms.add( (nodename, taxname) )
-    print len(node2taxname), "names loaded."
-    print len(synonyms), "synonyms loaded."
-
-    print "Loading nodes..."
-    for line in open("nodes.dmp"):
-        fields =  line.split("|")
-        nodename = fields[0].strip()
-        parentname = fields[1].strip()
-        n = Tree()
-        n.name = nodename
-        n.taxname = node2taxname[nodename]
-        n.rank = fields[2].strip()
-        parent2child[nodename] = parentname
-        name2node[nodename] = n
-    print len(name2node), "nodes loaded."
-
-    print "Linking nodes..."
-    for node in name2node:
-       if node == "1":
-           t = name2node[node]
-       else:
-           parent = parent2child[node]
-           parent_node = name2node[parent]
-           parent_node.add_child(name2node[node])
+    node2children = defaultdict(list)
+    with phase("load names"):
+        print "Loading node names..."
+        for line in open("names.dmp"):
+            fields =  map(strip, line.split("|"))
+            nodename = fields[0]
+            name_type = fields[3].lower()
+            taxname = fields[1]
+            if name_type == "scientific name":
+                node2taxname[nodename] = taxname
+            elif name_type in set(["synonym", "equivalent name", "genbank equivalent name",
+                                   "anamorph", "genbank synonym", "genbank anamorph", "teleomorph"]):
+                synonyms.add( (nodename, taxname) )
+        print len(node2taxname), "names loaded."
+        print len(synonyms), "synonyms loaded."
+
+    with phase("load nodes"):
+        print "Loading nodes..."
+        for line in open("nodes.dmp"):
+            fields =  line.split("|")
+            nodename = fields[0].strip()
+            parentname = fields[1].strip()
+            n = Tree()
+            n.name = nodename
+            n.taxname = node2taxname[nodename]
+            n.rank = fields[2].strip()
+            name2rank[nodename] = n.rank
+            parent2child[nodename] = parentname
+            name2node[nodename] = n
+        print len(name2node), "nodes loaded."
+
+    with phase("link"):
+        print "Linking nodes..."
+        for node in name2node:
+           if node == "1":
+               t = name2node[node]
+           else:
+               parent = parent2child[node]
+               parent_node = name2node[parent]
+               parent_node.add_child(name2node[node])
+               node2children[parent].append(node)
     print "Tree is loaded."
-    return t, synonyms
+    return t, synonyms, node2children, node2taxname, name2rank
+
+def write_ncbi_newick(fname, node2children, node2taxname, node2rank, rank_limit=None,
+                      compress=False):
+    # Extended newick of the whole taxonomy, written straight from the
+    # parent/children table in a single iterative pass. The output is the
+    # same as ete2's Tree.write(features=["name", "taxname"]). If rank_limit
+    # is given, nodes below that rank are discarded.
+    def children(taxid):
+        if rank_limit and node2rank[taxid] == rank_limit:
+            return []
+        return node2children.get(taxid, [])
+
+    def label(taxid, is_leaf):
+        features = nhx([("name", taxid), ("taxname", node2taxname[taxid])])
+        return "%s:1%s" %(taxid if is_leaf else "1", features)
+
+    OUT = open_output(fname, compress)
+    write_newicks("1", children, [(OUT, label)])
+    OUT.close()
+
+def name_key_fields(name):
+    return [str(name_length(name)), genus_token(name), str(qgram_signature(name)),
+            normalize_name(name, strip_strains=False)]
 
 def generate_table(t):
     OUT = open("taxa.tab", "w")
@@ -58,36 +96,135 @@ def generate_table(t):
             track.append(temp_node.name)
             temp_node = temp_node.up
         if n.up:
-            print >>OUT, '\t'.join([n.name, n.up.name, n.taxname, n.rank, ','.join(track)])
+            print >>OUT, '\t'.join([n.name, n.up.name, n.taxname, n.rank, ','.join(track)] + name_key_fields(n.taxname))
         else:
-            print >>OUT, '\t'.join([n.name, "", n.taxname, n.rank, ','.join(track)])
+            print >>OUT, '\t'.join([n.name, "", n.taxname, n.rank, ','.join(track)] + name_key_fields(n.taxname))
     OUT.close()
 
-    
-t, synonyms = load_ncbi_tree_from_dump()
+def generate_prefix_tables(t, synonyms):
+    # Autocomplete index. Names are weighted by the size of their clade, so
+    # the most inclusive (and usually most searched) taxa are suggested
+    # first, and scientific names go before synonyms.
+    weight = {}
+    for n in t.traverse("postorder"):
+        weight[n.name] = 1 + sum([weight[ch.name] for ch in n.children])
+    entries = []
+    taxid2rank = {}
+    for n in t.traverse():
+        taxid2rank[n.name] = n.rank
+        entries.append((prefix_key(n.taxname), n.taxname, n.name, n.rank, weight[n.name], 0))
+    for taxid, spname in synonyms:
+        if taxid in taxid2rank:
+            entries.append((prefix_key(spname), spname, taxid, taxid2rank[taxid], weight[taxid], 1))
+    entries.sort(key=lambda e: (-e[4], e[5], e[0]))
+
+    OUT = open("prefix.tab", "w")
+    for e in entries:
+        print >>OUT, '\t'.join(map(str, e))
+    OUT.close()
+
+    # Prefixes (in characters) shared by more than PREFIX_SCAN_SIZE names.
+    # Sorted keys sharing a prefix are contiguous, so those are the common
+    # prefixes of any two keys PREFIX_SCAN_SIZE positions apart, and all
+    # their shorter prefixes.
+    keys = sorted([e[0].decode("utf8") for e in entries])
+    broad = set()
+    for i in xrange(len(keys) - PREFIX_SCAN_SIZE):
+        common = os.path.commonprefix([keys[i], keys[i + PREFIX_SCAN_SIZE]])
+        for j in xrange(len(common), 0, -1):
+            if common[:j] in broad:
+                break
+            broad.add(common[:j])
+
+    # Best PREFIX_TOP_SIZE taxa of every broad prefix and rank, each with
+    # its best ranked name
+    TOP = open("prefix_best.tab", "w")
+    best2taxids = defaultdict(set)
+    for e in entries:
+        key = e[0].decode("utf8")
+        for i in xrange(1, len(key) + 1):
+            prefix = key[:i]
+            if prefix not in broad:
+                break
+            taxids = best2taxids[prefix, e[3]]
+            if len(taxids) < PREFIX_TOP_SIZE and e[2] not in taxids:
+                taxids.add(e[2])
+                print >>TOP, '\t'.join(map(str, (prefix.encode("utf8"),) + e))
+    TOP.close()
+
+parser = ArgumentParser(description="Builds taxa.sqlite from the NCBI taxdump files")
+parser.add_argument("--profile_json", dest="profile_json", type=str,
+                    help="Saves the timings of each phase as JSON into the given file")
+parser.add_argument("--gzip", dest="gzip", action="store_true",
+                    help="Writes ncbi.nw gzip compressed (ncbi.nw.gz)")
+parser.add_argument("--rank_limit", dest="rank_limits", type=str, nargs="+",
+                    help=("Also writes ncbi.<rank>.nw files, where all nodes"
+                          " under the given ranks are discarded"))
+args = parser.parse_args()
+
+t, synonyms, node2children, node2taxname, node2rank = load_ncbi_tree_from_dump()
 
 print "Updating database..."
-generate_table(t)
-open("syn.tab", "w").write('\n'.join(["%s\t%s" %(v[0],v[1]) for v in synonyms]))
+with phase("write table"):
+    generate_table(t)
+with phase("write synonyms"):
+    open("syn.tab", "w").write('\n'.join(['\t'.join([v[0], v[1]] + name_key_fields(v[1])) for v in synonyms]))
+with phase("write prefix tables"):
+    generate_prefix_tables(t, synonyms)
+
+# Build version, used to invalidate caches built on top of older DBs
+version = time.strftime("%Y%m%d%H%M%S")
 
 CMD = open("commands.tmp", "w")
 cmd = """
+DROP TABLE IF EXISTS stats;
 DROP TABLE IF EXISTS species;
 DROP TABLE IF EXISTS synonym; 
-CREATE TABLE species (taxid INT PRIMARY KEY, parent INT, spname VARCHAR(50) COLLATE NOCASE, rank VARCHAR(50), track TEXT);
-CREATE TABLE synonym (taxid INT,spname VARCHAR(50) COLLATE NOCASE, PRIMARY KEY (spname, taxid));
+DROP TABLE IF EXISTS prefix;
+DROP TABLE IF EXISTS prefix_top;
+DROP TABLE IF EXISTS prefix_best;
+CREATE TABLE stats (version TEXT);
+INSERT INTO stats VALUES ('%s');
+CREATE TABLE species (taxid INT PRIMARY KEY, parent INT, spname VARCHAR(50) COLLATE NOCASE, rank VARCHAR(50), track TEXT, namelen INT, genus VARCHAR(50), qsig INT, normname VARCHAR(50));
+CREATE TABLE synonym (taxid INT,spname VARCHAR(50) COLLATE NOCASE, namelen INT, genus VARCHAR(50), qsig INT, normname VARCHAR(50), PRIMARY KEY (spname, taxid));
 CREATE INDEX spname1 ON species (spname COLLATE NOCASE);
 CREATE INDEX spname2 ON synonym (spname COLLATE NOCASE);
+CREATE INDEX namelen1 ON species (namelen, qsig);
+CREATE INDEX namelen2 ON synonym (namelen, qsig);
+CREATE INDEX genus1 ON species (genus);
+CREATE INDEX genus2 ON synonym (genus);
+CREATE INDEX normname1 ON species (normname);
+CREATE INDEX normname2 ON synonym (normname);
+CREATE TABLE prefix (key TEXT, spname TEXT, taxid INT, rank VARCHAR(50), weight INT, synonym INT);
+CREATE TABLE prefix_best (prefix TEXT, key TEXT, spname TEXT, taxid INT, rank VARCHAR(50), weight INT, synonym INT);
+CREATE INDEX prefix1 ON prefix (key);
+CREATE INDEX prefix2 ON prefix_best (prefix);
 
 .separator "\t"
 .import taxa.tab species
 .import syn.tab synonym
+.import prefix.tab prefix
+.import prefix_best.tab prefix_best
 
-"""
+""" %version
 CMD.write(cmd)
 CMD.close()
-os.system("sqlite3 taxa.sqlite < commands.tmp")
+with phase("import"):
+    os.system("sqlite3 taxa.sqlite < commands.tmp")
+
+suffix = ".gz" if args.gzip else ""
+print "Creating extended newick file with the whole NCBI tree [ncbi.nw%s]" %suffix
+with phase("write newick"):
+    write_ncbi_newick("ncbi.nw" + suffix, node2children, node2taxname, node2rank,
+                      compress=args.gzip)
+for rank in args.rank_limits or []:
+    fname = "ncbi.%s.nw%s" %(rank.replace(" ", "_"), suffix)
+    print "Creating newick file pruned at rank %s [%s]" %(rank, fname)
+    with phase("write newick (%s)" %rank):
+        write_ncbi_newick(fname, node2children, node2taxname, node2rank, rank,
+                          compress=args.gzip)
 
-print "Creating extended newick file with the whole NCBI tree [ncbi.nw]"
-t.write(outfile="ncbi.nw", features=["name", "taxname"])
+profiling.report(sys.stdout)
+if args.profile_json:
+    profiling.dump_json(args.profile_json)
 